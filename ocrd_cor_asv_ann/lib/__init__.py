@@ -2,8 +2,13 @@
 
 Sequence2Sequence - encapsulates ANN model definition and application
 Node - tree data type for beam search
+BandedAlignment - compact soft alignment of decoder outputs to inputs
 Alignment - encapsulates global sequence alignment and distance metrics
+CorrectionCache - stores correction results by line content
+CorpusStore - training corpus compiled into memory-mapped arrays
 '''
 
 from .alignment import Alignment
-from .seq2seq import Sequence2Sequence, Node, GAP
+from .seq2seq import Sequence2Sequence, Node, BandedAlignment, GAP
+from .cache import CorrectionCache
+from .corpus import CorpusStore
@@ -0,0 +1,107 @@
+# -*- coding: utf-8
+import logging
+import hashlib
+import pickle
+import sqlite3
+import unicodedata
+from collections import OrderedDict
+
+import numpy as np
+
+from .corpus import is_confmat
+
+class CorrectionCache(object):
+    '''Cache of line correction results, keyed by content.
+
+    Keep up to `size` results in memory (evicting the least recently
+    used first). If `path` is given, then also persist all results in
+    an SQLite database file there, and look up results which are not
+    in memory from it.
+
+    Keys identify the input line (in NFC), its confidence values
+    (quantized to `precision` decimals), the model (checksum of the
+    weights) and the decoding parameters, see `make_key`.
+    '''
+    def __init__(self, size=10000, path=None, precision=1, logger=None):
+        self.logger = logger or logging.getLogger(__name__)
+        self.size = size
+        self.precision = precision
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.db = None
+        if path:
+            self.db = sqlite3.connect(path)
+            self.db.execute('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value BLOB)')
+            self.db.commit()
+            self.logger.info('Using correction cache "%s"', path)
+
+    def make_key(self, line, conf, checksum, params):
+        '''Get the key for correcting `line` with confidence `conf` (or None)
+        by the model with weights checksum `checksum` and decoding parameters
+        `params` (any tuple of literals).'''
+        if isinstance(conf, tuple):
+            # compiled confusion network: length and arrays of position, index and probability
+            length, positions, idxs, probs = conf
+            conf = (int(length), np.asarray(positions).tolist(), np.asarray(idxs).tolist(),
+                    np.round(np.asarray(probs, dtype=np.float64), self.precision).tolist())
+        elif conf:
+            if is_confmat(conf):
+                # confusion network: list of chunks of (string, probability) alternatives
+                conf = [[(unicodedata.normalize('NFC', chars), round(prob, self.precision))
+                         for chars, prob in chunk]
+                        for chunk in conf]
+            else:
+                conf = np.round(np.array(conf, dtype=np.float64), self.precision).tolist()
+        key = repr((unicodedata.normalize('NFC', line), conf, checksum, params))
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        '''Look up the result for `key` (or None if not cached).'''
+        value = self.entries.get(key)
+        if value is not None:
+            self.entries.move_to_end(key)
+        elif self.db:
+            row = self.db.execute('SELECT value FROM results WHERE key = ?', (key,)).fetchone()
+            if row:
+                value = pickle.loads(row[0])
+                self._put(key, value)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def put(self, key, value):
+        '''Store the result `value` under `key` (in memory and on disk).'''
+        self._put(key, value)
+        if self.db:
+            self.db.execute('INSERT OR REPLACE INTO results VALUES (?, ?)',
+                            (key, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)))
+
+    def _put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def flush(self):
+        '''Commit new results to disk.'''
+        if self.db:
+            self.db.commit()
+
+    def close(self):
+        '''Commit new results and close the database.'''
+        self.logger.info('Correction cache: %d hits, %d misses', self.hits, self.misses)
+        if self.db:
+            self.db.commit()
+            self.db.close()
+            self.db = None
+
+def file_checksum(filename):
+    '''Calculate the SHA1 hex digest of the file contents of `filename`.'''
+    checksum = hashlib.sha1()
+    with open(filename, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            checksum.update(block)
+    return checksum.hexdigest()
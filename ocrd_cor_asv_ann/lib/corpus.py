@@ -0,0 +1,387 @@
+# -*- coding: utf-8
+import os
+import json
+import logging
+import pickle
+import unicodedata
+import multiprocessing
+from array import array
+from itertools import islice
+
+import numpy as np
+
+from .alignment import Alignment
+
+MANIFEST = 'manifest.json'
+
+class CorpusStore(object):
+    '''Training corpus compiled into a directory of memory-mapped arrays.
+
+    Created once by `prepare` (or `cor-asv-ann-prepare`) from the same
+    text and pickle files that `Sequence2Sequence.train` would read
+    otherwise, this holds all lines as indexes into the character set
+    of the store (`chars`), concatenated into flat arrays, with offsets
+    for each line (so line `i` is `source[source_offsets[i]:source_offsets[i+1]]`):
+    - `source`: encoder input (first-best text for confusion networks)
+    - `target`: decoder input/output
+    - `source_conf`: confidence for each source character
+      (only if input had probabilities, otherwise None)
+    - `confmat_positions`, `confmat_indexes`, `confmat_probs`:
+      characters of all alternatives of confusion networks, with
+      `confmat_offsets` and encoder input length `confmat_lengths`
+      (only if input had confusion networks, otherwise None;
+      cf. `Sequence2Sequence.compile_confmat`)
+    - `bad`: whether the line was too bad to train on (cf. `Alignment.is_bad`)
+
+    Since arrays are opened with `mmap_mode`, slicing lines does not
+    read or copy the rest of the corpus.
+    '''
+    def __init__(self, path, mmap_mode='r'):
+        self.path = path
+        with open(os.path.join(path, MANIFEST), 'r') as file:
+            manifest = json.load(file)
+        self.files = manifest['files']
+        self.chars = manifest['chars']
+        self.confidence = manifest['confidence']
+        def load(name):
+            return np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode)
+        self.source = load('source')
+        self.source_offsets = load('source_offsets')
+        self.target = load('target')
+        self.target_offsets = load('target_offsets')
+        self.bad = load('bad')
+        self.source_conf = None
+        self.confmat_positions = self.confmat_indexes = self.confmat_probs = None
+        self.confmat_offsets = self.confmat_lengths = None
+        if self.confidence == 'probs':
+            self.source_conf = load('source_conf')
+        elif self.confidence == 'confmat':
+            self.confmat_positions = load('confmat_positions')
+            self.confmat_indexes = load('confmat_indexes')
+            self.confmat_probs = load('confmat_probs')
+            self.confmat_offsets = load('confmat_offsets')
+            self.confmat_lengths = load('confmat_lengths')
+
+    @staticmethod
+    def is_store(path):
+        '''Whether `path` is the directory of a compiled corpus.'''
+        return os.path.isfile(os.path.join(path, MANIFEST))
+
+    def __len__(self):
+        return len(self.bad)
+
+    def __repr__(self):
+        return '%s(%s: %d lines, %d chars, confidence=%s)' % (
+            self.__class__.__name__, self.path, len(self), len(self.chars), self.confidence)
+
+    def line(self, i):
+        '''Get the source and target string of line `i` (for inspection).'''
+        chars = np.array(self.chars)
+        return (''.join(chars[self.source[self.source_offsets[i]:self.source_offsets[i+1]]]),
+                ''.join(chars[self.target[self.target_offsets[i]:self.target_offsets[i+1]]]))
+
+def gather_lines(offsets, lines):
+    '''Find the elements of `lines` in a flat array with line `offsets`.
+
+    Return a 4-tuple of flat arrays of batch row, position and
+    element number for all elements of the lines (in turn),
+    and an array of line lengths.
+    '''
+    lines = np.asarray(lines, dtype=np.int64)
+    starts = np.asarray(offsets[lines], dtype=np.int64)
+    lengths = np.asarray(offsets[lines + 1], dtype=np.int64) - starts
+    rows = np.repeat(np.arange(len(lines)), lengths)
+    cols = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return rows, cols, np.repeat(starts, lengths) + cols, lengths
+
+def is_confmat(conf):
+    '''Whether the confidence `conf` of a line is a confusion network.
+
+    This can be either a list of chunks of alternatives, or its compiled
+    layout tuple (cf. `Sequence2Sequence.compile_confmat`), as opposed to
+    a list of probabilities (or None).
+    '''
+    return isinstance(conf, tuple) or bool(conf) and isinstance(conf[0], list)
+
+def flatten_confmat(confmat):
+    '''Flatten a confusion network into positions of characters.
+
+    Take `confmat`, a list of chunks, where each chunk is a list of
+    alternatives, which is a tuple of a string and its probability.
+    Characters of all alternatives of a chunk start at the same position,
+    and the next chunk starts after the longest alternative.
+
+    Return a 4-tuple of the length, the string of all characters,
+    and arrays of position and probability for each character.
+    '''
+    chars, starts, probs = [], [], []
+    length = 0
+    for chunk in confmat:
+        for alternative, prob in chunk:
+            chars.append(alternative)
+            starts.append(length)
+            probs.append(prob)
+        length += max([len(x[0]) for x in chunk]) if chunk else 0
+    lengths = np.array([len(alternative) for alternative in chars], dtype=np.int64)
+    text = ''.join(chars)
+    positions = (np.repeat(np.array(starts, dtype=np.int64), lengths) + np.arange(len(text)) -
+                 np.repeat(np.cumsum(lengths) - lengths, lengths))
+    probs = np.repeat(np.array(probs, dtype=np.float32), lengths)
+    return length, text, positions, probs
+
+def read_lines(filename):
+    '''Read pairs of source and target lines from `filename`.
+
+    Plain text files (not ending in `.pkl`) have the source and target
+    string of each line separated by tab. Pickle dumps contain a list of
+    source and target pairs, where the source can be a list of character
+    and probability tuples, or a confusion network (a list of chunks of
+    string and probability tuples).
+
+    Yield 4-tuples of the original line (string or pair), the source
+    and target string (normalized to NFC, with end-of-sequence) and
+    the source confidence (None for plain text, list of probabilities,
+    or confusion network).
+    '''
+    with_confidence = filename.endswith('.pkl')
+    with open(filename, 'rb' if with_confidence else 'r') as file:
+        if with_confidence:
+            file = pickle.load(file) # read once
+        for line in file:
+            if with_confidence:
+                source_text, target_text = line # already includes end-of-sequence
+                if not source_text: # empty
+                    source_text, source_conf = '', []
+                elif type(source_text[0]) is tuple: # prob line
+                    source_text, source_conf = map(list, zip(*source_text))
+                    source_text = ''.join(source_text)
+                else: # confmat
+                    source_conf = source_text
+                    source_text = ''.join(chunk[0][0] if chunk else '' for chunk in source_text)
+            else:
+                source_text, target_text = line.split('\t')
+                # add end-of-sequence:
+                source_text = source_text + '\n'
+                source_conf = None
+            yield (line,
+                   unicodedata.normalize('NFC', source_text),
+                   unicodedata.normalize('NFC', target_text),
+                   source_conf)
+
+def _check_lines(pairs):
+    aligner = Alignment(0)
+    results = []
+    for source_text, target_text in pairs:
+        aligner.set_seqs(source_text, target_text)
+        results.append((aligner.matcher.quick_ratio(),
+                        aligner.get_levenshtein_distance(source_text, target_text),
+                        aligner.is_bad()))
+    return results
+
+def check_lines(pairs, processes=None, chunksize=1000):
+    '''Align source and target strings to find bad lines (in parallel).
+
+    Distribute `pairs` (an iterable of source and target strings)
+    in chunks of `chunksize` over a pool of `processes` workers
+    (all cores if None, none if 1), and align each pair.
+
+    Yield 3-tuples of similarity ratio, (relative) edit distance and
+    whether the line is too bad to train on (cf. `Alignment.is_bad`),
+    in the order of `pairs`.
+    '''
+    pairs = iter(pairs)
+    chunks = iter(lambda: list(islice(pairs, chunksize)), [])
+    if processes == 1:
+        for chunk in chunks:
+            for result in _check_lines(chunk):
+                yield result
+        return
+    with multiprocessing.Pool(processes) as pool:
+        for results in pool.imap(_check_lines, chunks):
+            for result in results:
+                yield result
+
+def clean(filenames, path, processes=None, logger=None):
+    '''Filter bad lines from `filenames` into directory `path` (in parallel).
+
+    Read each file (cf. `read_lines`), align its lines (cf. `check_lines`),
+    and write all lines which are not too bad to train on into a file of
+    the same name and format under `path` (creating it if necessary).
+    Also write a per-line report (`report.tsv`, with file, line number,
+    similarity ratio, edit distance and decision), and the decisions
+    (`decisions.json`, with the bad line numbers for the absolute path of
+    each original and cleaned file, cf. `load_decisions`).
+
+    Return the decisions.
+    '''
+    logger = logger or logging.getLogger(__name__)
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    outputs = [os.path.join(path, os.path.basename(filename)) for filename in filenames]
+    if len(set(outputs)) < len(outputs):
+        raise Exception('cannot clean files with the same name into "%s"' % path)
+    decisions = dict()
+    with open(os.path.join(path, 'report.tsv'), 'w') as report:
+        report.write('file\tline\tratio\tdistance\tdecision\n')
+        for filename, output in zip(filenames, outputs):
+            lines = list(read_lines(filename))
+            good = []
+            bad = []
+            results = check_lines(((source_text, target_text)
+                                   for _, source_text, target_text, _ in lines),
+                                  processes=processes)
+            for line_no, ((line, _, _, _), (ratio, distance, is_bad)) in enumerate(zip(lines, results)):
+                report.write('%s\t%d\t%.3f\t%.3f\t%s\n' % (
+                    filename, line_no, ratio, distance, 'bad' if is_bad else 'good'))
+                if is_bad:
+                    bad.append(line_no)
+                else:
+                    good.append(line)
+            if filename.endswith('.pkl'):
+                with open(output, 'wb') as file:
+                    pickle.dump(good, file)
+            else:
+                with open(output, 'w') as file:
+                    file.writelines(good)
+            decisions[os.path.abspath(filename)] = bad
+            decisions[os.path.abspath(output)] = []
+            logger.info('cleaned "%s" into "%s" (%d of %d lines bad)',
+                        filename, output, len(bad), len(lines))
+    with open(os.path.join(path, 'decisions.json'), 'w') as file:
+        json.dump(decisions, file, indent=1)
+    return decisions
+
+def load_decisions(filename):
+    '''Load bad-line decisions written by `clean` from `filename`.
+
+    Return a dict of absolute file paths to sets of bad line numbers
+    (for `Sequence2Sequence.line_filter`).
+    '''
+    with open(filename, 'r') as file:
+        return dict((path, set(lines)) for path, lines in json.load(file).items())
+
+def _codes(text):
+    return array('I', text.encode('utf-32-le')) if text else array('I')
+
+def prepare(filenames, path, processes=None, logger=None, blocksize=100000):
+    '''Compile the lines in `filenames` into a `CorpusStore` at `path`.
+
+    Read text files (tab-separated source and target lines) and
+    pickle dumps (lists of source and target pairs, where the source
+    can be a list of character and probability tuples, or a confusion
+    network), just like `Sequence2Sequence.gen_lines` does (cf. `read_lines`).
+    Align each pair to mark bad lines (using a pool of `processes`, cf.
+    `check_lines`), and map all characters to the sorted set of characters
+    found. Read and align files in blocks of `blocksize` lines, so only
+    the compiled arrays are kept in memory.
+
+    If any input has confusion networks, store all lines as such
+    (with probability 1 for lines without). Otherwise, if any input
+    has probabilities, store them for all lines (1 for lines without).
+    (Lines before the first such input get converted when it is found.)
+
+    Write all arrays into directory `path` (creating it if necessary),
+    and return the `CorpusStore` opened from there.
+    '''
+    logger = logger or logging.getLogger(__name__)
+    source, source_offsets = array('I'), array('q', [0])
+    target, target_offsets = array('I'), array('q', [0])
+    source_conf = None # (only once probabilities are found)
+    confmat_positions = confmat_indexes = confmat_probs = None # (only once confusion networks are found)
+    confmat_offsets = confmat_lengths = None
+    bad = array('b')
+    with_probs = with_confmat = False
+    def ones(length):
+        return array('f', np.ones(length, dtype=np.float32).tobytes())
+    for filename in filenames:
+        lines = read_lines(filename)
+        for block in iter(lambda: list(islice(lines, blocksize)), []):
+            results = check_lines(((source_text, target_text)
+                                   for _, source_text, target_text, _ in block),
+                                  processes=processes)
+            for (_, source_text, target_text, source_conf_line), (_, _, is_bad) in zip(block, results):
+                confmat = None
+                if is_confmat(source_conf_line):
+                    confmat = flatten_confmat(source_conf_line)
+                    source_conf_line = None
+                    if not with_confmat:
+                        # convert all previous lines to trivial confusion networks:
+                        lengths = np.diff(np.asarray(source_offsets))
+                        starts = np.repeat(np.asarray(source_offsets[:-1]), lengths)
+                        confmat_positions = array('q', (np.arange(len(source)) - starts).astype(np.int64).tobytes())
+                        confmat_indexes = array('I', source)
+                        confmat_probs = source_conf if with_probs else ones(len(source))
+                        confmat_offsets = array('q', source_offsets)
+                        confmat_lengths = array('q', lengths.astype(np.int64).tobytes())
+                        source_conf = None
+                        with_confmat = True
+                elif source_conf_line: # prob line
+                    if not with_probs and not with_confmat:
+                        # all previous lines had probability 1:
+                        source_conf = ones(len(source))
+                    with_probs = True
+                bad.append(is_bad)
+                source.extend(_codes(source_text))
+                source_offsets.append(len(source))
+                target.extend(_codes(target_text))
+                target_offsets.append(len(target))
+                if not with_probs and not with_confmat:
+                    continue
+                if source_conf_line is None:
+                    source_conf_line = np.ones(len(source_text), dtype=np.float32)
+                else:
+                    # (pad or cut in case normalization changed the length)
+                    source_conf_line = np.resize(np.array(source_conf_line, dtype=np.float32),
+                                                 len(source_text))
+                if not with_confmat:
+                    source_conf.extend(array('f', source_conf_line.tobytes()))
+                    continue
+                if confmat is None:
+                    confmat = (len(source_text), source_text,
+                               np.arange(len(source_text)), source_conf_line)
+                length, text, positions, probs = confmat
+                confmat_positions.extend(array('q', positions.astype(np.int64).tobytes()))
+                confmat_indexes.extend(_codes(text))
+                confmat_probs.extend(array('f', probs.astype(np.float32).tobytes()))
+                confmat_offsets.append(len(confmat_indexes))
+                confmat_lengths.append(length)
+        logger.info('compiled "%s" (%d lines in total)', filename, len(bad))
+    # map codepoints to the character set:
+    source = np.asarray(source, dtype=np.uint32)
+    target = np.asarray(target, dtype=np.uint32)
+    if with_confmat:
+        confmat_indexes = np.asarray(confmat_indexes, dtype=np.uint32)
+        codes = np.unique(np.concatenate([source, target, confmat_indexes]))
+    else:
+        codes = np.unique(np.concatenate([source, target]))
+    chars = [chr(code) for code in codes]
+    dtype = np.uint16 if len(chars) <= np.iinfo(np.uint16).max else np.int32
+    def save(name, data, dtype=None):
+        np.save(os.path.join(path, name + '.npy'), np.asarray(data, dtype=dtype))
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    save('source', np.searchsorted(codes, source), dtype)
+    save('source_offsets', source_offsets, np.int64)
+    save('target', np.searchsorted(codes, target), dtype)
+    save('target_offsets', target_offsets, np.int64)
+    save('bad', bad, np.bool_)
+    if with_confmat:
+        confidence = 'confmat'
+        save('confmat_positions', confmat_positions, np.int32)
+        save('confmat_indexes', np.searchsorted(codes, confmat_indexes), dtype)
+        save('confmat_probs', confmat_probs, np.float32)
+        save('confmat_offsets', confmat_offsets, np.int64)
+        save('confmat_lengths', confmat_lengths, np.int32)
+    elif with_probs:
+        confidence = 'probs'
+        save('source_conf', source_conf, np.float32)
+    else:
+        confidence = None
+    # manifest last (marks the store complete):
+    with open(os.path.join(path, MANIFEST), 'w') as file:
+        json.dump({'files': list(filenames),
+                   'chars': chars,
+                   'confidence': confidence}, file, ensure_ascii=False, indent=1)
+    store = CorpusStore(path)
+    logger.info('compiled %s (%d bad lines)', store, np.count_nonzero(store.bad))
+    return store
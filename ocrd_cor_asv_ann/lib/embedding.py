@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+from keras import backend as K
+from keras import initializers, regularizers, constraints
+from keras.layers import Layer
+
+
+class SparseEmbedding(Layer):
+    """Embedding for index-based (sparse) input vectors.
+
+    This computes the same as a time-distributed `Dense` layer (without bias)
+    applied to input vectors of size `input_dim`, but instead of the full
+    (mostly zero) vectors, it takes only their non-zero entries as pairs
+    of index and value. It gathers the kernel rows of these indexes, and
+    sums them weighted by their values. (So unit vectors become a single
+    pair with value 1, and padding becomes pairs with value 0.)
+
+    The kernel has the same shape as that of the `Dense` layer, so weights
+    can be exchanged between both.
+
+    # Arguments
+        input_dim: Integer. Size of the input vectors (i.e. vocabulary size).
+        units: Positive integer, dimensionality of the output space.
+        kernel_initializer: Initializer for the `kernel` weights matrix.
+        kernel_regularizer: Regularizer function applied to
+            the `kernel` weights matrix.
+        kernel_constraint: Constraint function applied to
+            the `kernel` weights matrix.
+
+    # Input shape
+        4D tensor with shape: `(batch_size, timesteps, k, 2)`,
+        with k pairs of (float) index and value for each timestep.
+
+    # Output shape
+        3D tensor with shape: `(batch_size, timesteps, units)`.
+    """
+    def __init__(self, input_dim, units,
+                 kernel_initializer='glorot_uniform',
+                 kernel_regularizer=None,
+                 kernel_constraint=None,
+                 **kwargs):
+        super(SparseEmbedding, self).__init__(**kwargs)
+        self.input_dim = input_dim
+        self.units = units
+        self.kernel_initializer = initializers.get(kernel_initializer)
+        self.kernel_regularizer = regularizers.get(kernel_regularizer)
+        self.kernel_constraint = constraints.get(kernel_constraint)
+
+    def build(self, input_shape):
+        self.kernel = self.add_weight(shape=(self.input_dim, self.units),
+                                      initializer=self.kernel_initializer,
+                                      name='kernel',
+                                      regularizer=self.kernel_regularizer,
+                                      constraint=self.kernel_constraint)
+        self.built = True
+
+    def call(self, inputs):
+        indexes = K.cast(inputs[:, :, :, 0], 'int32')
+        values = inputs[:, :, :, 1]
+        vectors = K.gather(self.kernel, indexes)
+        return K.sum(vectors * K.expand_dims(values, -1), axis=2)
+
+    def compute_output_shape(self, input_shape):
+        return input_shape[:2] + (self.units,)
+
+    def get_config(self):
+        config = {
+            'input_dim': self.input_dim,
+            'units': self.units,
+            'kernel_initializer': initializers.serialize(self.kernel_initializer),
+            'kernel_regularizer': regularizers.serialize(self.kernel_regularizer),
+            'kernel_constraint': constraints.serialize(self.kernel_constraint)
+        }
+        base_config = super(SparseEmbedding, self).get_config()
+        return dict(list(base_config.items()) + list(config.items()))
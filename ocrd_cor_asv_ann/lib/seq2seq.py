@@ -1,12 +1,16 @@
 # -*- coding: utf-8
+import os
 import unicodedata
 import math
+import time
 import logging
 import pickle
 import numpy as np
 import h5py
 
 from .alignment import Alignment, Edits
+from .cache import file_checksum
+from .corpus import CorpusStore, gather_lines, flatten_confmat, is_confmat
 
 GAP = '\a' # reserved character that does not get mapped (for gap repairs)
 
@@ -130,6 +134,15 @@ class Sequence2Sequence(object):
         # use a fully connected non-linear layer to transfer
         # encoder final states to decoder initial states instead of copy?
         self.bridge_dense = False
+        # feed characters to the model as index/probability pairs
+        # (gathering their embeddings) instead of as vectors over
+        # the whole vocabulary, and train with sparse targets?
+        # (weights are the same either way)
+        self.sparse_input = False
+        # up to how many index/probability pairs per input position
+        # with sparse_input (for confusion networks, and for feeding
+        # back the output distribution into the decoder)?
+        self.sparse_topk = 5
         
         ### training parameters
         # maximum number of epochs to train
@@ -155,6 +168,10 @@ class Sequence2Sequence(object):
         self.scheduled_sampling = None # 'linear'/'sigmoid'/'exponential'/None
         # rate of dropped output connections in encoder and decoder HL?
         self.dropout = 0.2
+        # recorded decisions which lines are too bad to train on
+        # (dict of absolute file paths to sets of line numbers,
+        #  cf. cor-asv-ann-clean), skipping the alignment for these files?
+        self.line_filter = None
         
         ### beam decoder inference parameters
         # probability of the input character candidate in each hypothesis
@@ -165,8 +182,60 @@ class Sequence2Sequence(object):
         # how much worse relative to the probability of the best candidate
         # may new candidates be to enter the beam?
         self.beam_threshold_in = 0.2
+        # narrow the beam width for each hypothesis (down to 1) where
+        # the input character (at the estimated source position) has
+        # high OCR confidence and the output distribution has low entropy?
+        self.beam_adaptive = False
         # up to how many results can be drawn from result generator?
         self.beam_width_out = 16
+        # up to how many hypotheses (across all lines) can be decoded in one batch?
+        self.beam_batch_size = 256
+        # recombine hypotheses with the same output suffix of this length
+        # and the same estimated source position (keeping only the cheaper
+        # path, since their futures will be nearly the same)? (0 disables)
+        self.beam_recombination = 0
+        # up to how many hypotheses can be expanded per line
+        # (besides the limit relative to the line length)? (0 disables)
+        self.beam_max_expansions = 0
+        # decode greedily first, and prune beam hypotheses
+        # which cannot become cheaper than that solution?
+        self.beam_greedy_bound = False
+        # when decoding greedily, verify the input characters as a draft
+        # (in parallel), and only decode step by step where they disagree?
+        # (feeding back the draft as unit vectors instead of the soft
+        #  output scores, so results can differ from plain greedy decoding)
+        self.speculative = False
+        # up to how many lines (sorted by length) to process at once
+        # in correct_lines? (0 means all lines at once)
+        self.bucket_size = 0
+        # cache for correction results in correct_lines
+        # (a CorrectionCache, or None to disable)
+        self.cache = None
+        # minimum OCR confidence of all characters in a line
+        # to pass it through unchanged (without decoding)? (0 disables)
+        self.passthrough_threshold = 0
+        # likewise for sequences of words within lines
+        # (decoding only the remaining parts of the line)?
+        self.passthrough_spans = False
+        # when beam decoding, decode greedily first, and use beam search
+        # only for lines where the greedy solution has a perplexity above
+        # cascade_perplexity, or a (relative) edit distance to the input
+        # above cascade_distance? (0 disables each criterion, both disable
+        # the cascade)
+        self.cascade_perplexity = 0
+        self.cascade_distance = 0
+        # split lines longer than this many characters into overlapping
+        # windows (at whitespace), decode them separately, and join
+        # them again? (0 disables)
+        self.window_size = 0
+        # by how many characters should consecutive windows overlap
+        # (i.e. how much context to add on either side of a window)?
+        self.window_overlap = 20
+        # how many consecutive input positions to keep in the (banded)
+        # alignment of each output character? (the local attention
+        # window keeps positions closer than 5 to a fractional timestep,
+        # i.e. up to 2*5 positions, so this loses nothing)
+        self.alignment_width = 10
 
         ### runtime variables
         self.logger = logger or logging.getLogger(__name__)
@@ -177,6 +246,10 @@ class Sequence2Sequence(object):
         self.aligner = Alignment(0, logger=self.logger) # aligner (for training) with internal state
         self.progbars = progbars
         self.status = 0 # empty / configured / trained?
+        self.checksum = None # of the loaded weights file (for caching)
+        self.cascade_counts = {'greedy': 0, 'beamed': 0} # lines per cascade tier
+        self.exhausted_count = 0 # lines where beam search ran out of budget
+        self.char_lookup = None # codepoint-to-index table for mapping (compiled on demand)
     
     def __repr__(self):
         return (__name__ +
@@ -203,6 +276,7 @@ class Sequence2Sequence(object):
         from keras import backend as K
         import tensorflow as tf
         from .attention import DenseAnnotationAttention
+        from .embedding import SparseEmbedding
         
         if batch_size:
             self.batch_size = batch_size
@@ -234,13 +308,24 @@ class Sequence2Sequence(object):
         ### Define training phase model
         
         # encoder part:
-        encoder_input = Input(shape=(None, self.voc_size),
+        if self.sparse_input:
+            # index/probability pairs (and embedding gather):
+            input_shape = (None, None, 2)
+            char_embedding = SparseEmbedding(self.voc_size, self.width,
+                                             kernel_initializer=RandomNormal(stddev=0.001),
+                                             kernel_regularizer=self._regularise_chars,
+                                             name='char_input_projection')
+            char_input_proj = char_embedding
+        else:
+            # unit/probability vectors (and embedding product):
+            input_shape = (None, self.voc_size)
+            char_embedding = Dense(self.width, use_bias=False,
+                                   kernel_initializer=RandomNormal(stddev=0.001),
+                                   kernel_regularizer=self._regularise_chars,
+                                   name='char_embedding')
+            char_input_proj = TimeDistributed(char_embedding, name='char_input_projection')
+        encoder_input = Input(shape=input_shape,
                               name='encoder_input')
-        char_embedding = Dense(self.width, use_bias=False,
-                               kernel_initializer=RandomNormal(stddev=0.001),
-                               kernel_regularizer=self._regularise_chars,
-                               name='char_embedding')
-        char_input_proj = TimeDistributed(char_embedding, name='char_input_projection')
         encoder_output = char_input_proj(encoder_input)
         
         if self.deep_bidirectional_encoder:
@@ -314,7 +399,7 @@ class Sequence2Sequence(object):
                                           name='attention_dense')
         
         # decoder part:
-        decoder_input = Input(shape=(None, self.voc_size),
+        decoder_input = Input(shape=input_shape,
                               name='decoder_input')
         decoder_input0 = char_input_proj(decoder_input)
         decoder_output = decoder_input0
@@ -492,16 +577,21 @@ class Sequence2Sequence(object):
         from keras.optimizers import Adam
         
         self.encoder_decoder_model.compile(
-            loss='categorical_crossentropy', # loss_weights=[1.,1.] if self.lm_loss
+            loss=('sparse_categorical_crossentropy' if self.sparse_input
+                  else 'categorical_crossentropy'), # loss_weights=[1.,1.] if self.lm_loss
             optimizer=Adam(clipnorm=5), #'adam',
             sample_weight_mode='temporal') # sample_weight slows down training slightly (20%)
     
     def _reconfigure_for_mapping(self):
         '''Reconfigure character embedding layer after change of mapping (possibly transferring previous weights).'''
         
+        from keras import backend as K
+        
         assert self.status >= 1
-        embedding = self.encoder_decoder_model.get_layer(name='char_input_projection').layer # cannot get char_embedding directly
-        input_dim = embedding.input_spec.axes[-1]
+        embedding = self.encoder_decoder_model.get_layer(name='char_input_projection')
+        if not self.sparse_input:
+            embedding = embedding.layer # cannot get char_embedding directly
+        input_dim, units = K.int_shape(embedding.kernel)
         if input_dim < self.voc_size: # more chars than during last training?
             if self.status >= 2: # weights exist already (i.e. incremental training)?
                 self.logger.warning('transferring weights from previous model with only %d character types', input_dim)
@@ -516,7 +606,7 @@ class Sequence2Sequence(object):
                         # transfer weights from previous Embedding layer to new one:
                         new_weights = layer.get_weights() # freshly initialised
                         #new_weights[0][input_dim:, 0:embedding.units] = weights[0][0,:] # repeat zero vector instead
-                        new_weights[0][0:input_dim, 0:embedding.units] = weights[0]
+                        new_weights[0][0:input_dim, 0:units] = weights[0]
                         layer.set_weights(new_weights)
                     else:
                         # use old weights:
@@ -555,6 +645,11 @@ class Sequence2Sequence(object):
     def map_files(self, filenames):
         num_lines = 0
         chars = set(self.mapping[0].keys()) # includes '' (0)
+        if isinstance(filenames, CorpusStore):
+            # compiled corpus: character set already known
+            chars.update(set(filenames.chars) - set([GAP]))
+            num_lines = len(filenames)
+            filenames = []
         for filename in filenames:
             # todo: there must be a better way to detect this:
             with_confidence = filename.endswith('.pkl')
@@ -599,16 +694,28 @@ class Sequence2Sequence(object):
         Validate on a random fraction of lines automatically separated before,
         unless `val_filenames` is given, in which case only those files are used
         for validation.
+        
+        Instead of files, `filenames` and `val_filenames` can also be
+        a single `CorpusStore` (or the path of one, see `cor-asv-ann-prepare`),
+        in which case batches are sliced from its arrays directly.
         '''
         from keras.callbacks import EarlyStopping, TerminateOnNaN
         from .callbacks import StopSignalCallback, ResetStatesCallback
         from .keras_train import fit_generator_autosized, evaluate_generator_autosized
 
+        if len(filenames) == 1 and CorpusStore.is_store(filenames[0]):
+            filenames = CorpusStore(filenames[0])
+        if val_filenames and len(val_filenames) == 1 and CorpusStore.is_store(val_filenames[0]):
+            val_filenames = CorpusStore(val_filenames[0])
         num_lines = self.map_files(filenames)
-        self.logger.info('Training on "%d" files with %d lines', len(filenames), num_lines)
+        self.logger.info('Training on "%d" files with %d lines',
+                         len(filenames.files if isinstance(filenames, CorpusStore) else filenames),
+                         num_lines)
         if val_filenames:
             num_lines = self.map_files(val_filenames)
-            self.logger.info('Validating on "%d" files with %d lines', len(val_filenames), num_lines)
+            self.logger.info('Validating on "%d" files with %d lines',
+                             len(val_filenames.files if isinstance(val_filenames, CorpusStore) else val_filenames),
+                             num_lines)
             split_rand = None
         else:
             self.logger.info('Validating on random 20% lines from those files')
@@ -682,16 +789,18 @@ class Sequence2Sequence(object):
             source_lines, target_lines, sourceconf_lines = batch
             #bar.update(1)
 
-            greedy_lines, greedy_probs, greedy_scores, _ = (
-                self.correct_lines(source_lines, sourceconf_lines,
-                                   fast=fast, greedy=True))
             if fast:
+                greedy_lines, greedy_probs, greedy_scores, _ = (
+                    self.correct_lines(source_lines, sourceconf_lines,
+                                       fast=True, greedy=True))
                 beamed_lines, beamed_probs, beamed_scores = (
                     greedy_lines, greedy_probs, greedy_scores)
             else:
-                beamed_lines, beamed_probs, beamed_scores, _ = (
+                # vectorize and encode only once for both greedy and beamed:
+                (beamed_lines, beamed_probs, beamed_scores, _,
+                 greedy_lines, greedy_probs, greedy_scores, _) = (
                     self.correct_lines(source_lines, sourceconf_lines,
-                                       fast=False, greedy=False))
+                                       fast=False, greedy=False, also_greedy=True))
             for j in range(len(source_lines)):
                 if not source_lines[j] or not target_lines[j]:
                     continue # from partially filled batch
@@ -730,6 +839,11 @@ class Sequence2Sequence(object):
             c_beamed_counts.score += sum(beamed_scores)
 
         self.logger.info('finished %d lines', c_ocr_counts.length)
+        if not fast and (self.cascade_perplexity or self.cascade_distance):
+            self.logger.info('cascade: %d lines greedy, %d lines beamed',
+                             self.cascade_counts['greedy'], self.cascade_counts['beamed'])
+        if not fast and self.exhausted_count:
+            self.logger.warning('beam search budget exhausted for %d lines', self.exhausted_count)
         if confusion > 0:
             self.logger.info('OCR confusion: %s', c_ocr_aligner.get_confusion(confusion))
             self.logger.info('greedy confusion: %s', c_greedy_aligner.get_confusion(confusion))
@@ -743,7 +857,7 @@ class Sequence2Sequence(object):
         self.logger.info("WER greedy: %.3f±%.3f", w_greedy_counts.mean, math.sqrt(w_greedy_counts.varia))
         self.logger.info("WER beamed: %.3f±%.3f", w_beamed_counts.mean, math.sqrt(w_beamed_counts.varia))
         
-    def correct_lines(self, lines, conf=None, fast=True, greedy=True):
+    def correct_lines(self, lines, conf=None, fast=True, greedy=True, deadline=None, also_greedy=False):
         '''apply correction model on text strings
         
         Pass the character sequences `lines` (optionally complemented by
@@ -753,48 +867,423 @@ class Sequence2Sequence(object):
         
         If `fast`, process all lines in parallel and all characters at once
         greedily.
-        Otherwise, if `greedy`, process each line greedily (i.e. without
-        beam search).
+        Otherwise, if `greedy`, encode all lines at once, then decode them
+        greedily (i.e. without beam search) in parallel, stepping through
+        characters as in `decode_sequence_greedy`.
+        If `speculative` (and `greedy`), then process all lines in parallel,
+        but decode characters step by step only where the model disagrees
+        with the input.
+        
+        If `beam_greedy_bound` (and not `lm_predict`), then decode greedily
+        before beam search, so the greedy solution can be used to prune
+        the search (and as a fallback).
+        If `also_greedy` (and not `greedy`), then do so in any case, and
+        also return the greedy results (from the same encoder outputs).
+        If `cascade_perplexity` or `cascade_distance` is non-zero (and not
+        `greedy`), then do so in any case, and keep the greedy solution
+        of each line unless it is worse than those thresholds (counting
+        lines per tier in `cascade_counts`).
+        
+        If `deadline` is given (as in `time.time()`), then stop beam search
+        at that time, and use the best solution found so far (or else
+        the greedy solution) for lines which have not finished yet
+        (counting such lines in `exhausted_count`).
+        
+        If `bucket_size` is non-zero, then sort lines by length and
+        process them in buckets of that many lines (each padded to its
+        own longest line).
+        
+        If `cache` is set, then look up each line (with its confidence, the
+        model and decoding parameters) there first, only correct lines not
+        found (each distinct line only once), and store their results (unless
+        the search budget was exhausted).
+        
+        If `passthrough_threshold` is non-zero and (simple) confidences
+        are given, then do not decode lines where all characters have at
+        least that confidence, but keep them as they are (with identity
+        alignment). If `passthrough_spans`, then do the same with
+        sequences of words, and decode only the remaining parts of lines
+        (each on its own).
+        
+        If `window_size` is non-zero, then split lines longer than that
+        into windows (overlapping by `window_overlap` characters on either
+        side), decode all windows on their own (along with the other lines),
+        and join their results (cutting at whitespace inside the overlaps).
         
         Return a 4-tuple of the corrected lines, probability lists,
-        perplexity scores, and input-output alignments.
+        perplexity scores, and input-output alignments (each as a
+        `BandedAlignment` of `alignment_width`, cut to the length of
+        its input line), or an 8-tuple
+        if `also_greedy`, with the greedy results in the same form.
         '''
         assert not fast or greedy, "cannot decode in fast mode with beam search enabled"
+        also_greedy = also_greedy and not greedy
+        confmat = conf and any(is_confmat(line_conf) for line_conf in conf)
+        
+        if (self.window_size and not confmat and
+            any(len(line) > self.window_size for line in lines)):
+            return self._correct_windowed(lines, conf, fast=fast, greedy=greedy, deadline=deadline,
+                                          also_greedy=also_greedy)
+        return self._correct_gated(lines, conf, fast=fast, greedy=greedy, deadline=deadline,
+                                   also_greedy=also_greedy)
+    
+    def _correct_windowed(self, lines, conf=None, fast=True, greedy=True, deadline=None, also_greedy=False):
+        '''apply correction model on text strings (long lines in windows)
+        
+        See `correct_lines`.
+        '''
+        width = 8 if also_greedy else 4
+        windows = [self._get_windows(line) if len(line) > self.window_size else None
+                   for line in lines]
+        inputs, inputs_conf = [], []
+        for j, line in enumerate(lines):
+            if not windows[j]:
+                inputs.append(line)
+                inputs_conf.append(conf[j] if conf else None)
+                continue
+            for start, end, _, _ in windows[j]:
+                if end < len(line):
+                    # not at the end of the line: add end-of-sequence symbol
+                    inputs.append(line[start:end] + '\n')
+                    inputs_conf.append(list(conf[j][start:end]) + [1.0] if conf else None)
+                else:
+                    inputs.append(line[start:end])
+                    inputs_conf.append(list(conf[j][start:end]) if conf else None)
+        self.logger.debug('decoding %d long lines in %d windows',
+                          len(lines) - windows.count(None),
+                          len(inputs) - windows.count(None))
+        results = list(zip(*self._correct_gated(inputs, inputs_conf if conf else None,
+                                                fast=fast, greedy=greedy, deadline=deadline,
+                                                also_greedy=also_greedy)))
+        results.reverse() # to pop in order
+        outputs = []
+        for line, line_windows in zip(lines, windows):
+            if not line_windows:
+                outputs.append(results.pop())
+                continue
+            line_results = [results.pop() for _ in line_windows]
+            output = ()
+            for k in range(0, width, 4): # beamed and/or greedy
+                pieces = []
+                for (start, end, cut_start, cut_end), result in zip(line_windows, line_results):
+                    window_line, window_probs, _, window_alignment = result[k:k + 4]
+                    # keep only the outputs aligned between the cuts:
+                    positions = start + window_alignment.positions()
+                    first = next((i for i, pos in enumerate(positions) if pos >= cut_start), len(positions))
+                    last = next((i for i, pos in enumerate(positions) if pos >= cut_end), len(positions))
+                    last = max(first, last)
+                    pieces.append((start, end, window_line[first:last],
+                                   window_probs[first:last], window_alignment[first:last]))
+                output += _join_pieces(len(line), pieces)
+            outputs.append(output)
+        return tuple(map(list, zip(*outputs)))
+    
+    def _get_windows(self, line):
+        '''Split a long line into overlapping windows.
+        
+        Cut `line` at whitespace into parts of up to `window_size`
+        characters minus twice the `window_overlap`, then extend each
+        part by up to `window_overlap` characters of context on either
+        side (also up to whitespace, where possible).
+        
+        Return a list of 4-tuples of start and end position of each
+        window, and start and end position of its part (between the cuts).
+        '''
+        step = max(1, self.window_size - 2 * self.window_overlap)
+        cuts = [0]
+        while len(line) - cuts[-1] > step:
+            cut = cuts[-1] + step
+            # cut after the last whitespace in the second half of the part:
+            space = line.rfind(' ', cuts[-1] + step // 2, cut)
+            if space >= 0:
+                cut = space + 1
+            cuts.append(cut)
+        cuts.append(len(line))
+        windows = []
+        for cut_start, cut_end in zip(cuts[:-1], cuts[1:]):
+            start = max(0, cut_start - self.window_overlap)
+            if start > 0:
+                # start after the first whitespace of the context:
+                space = line.find(' ', start, cut_start)
+                if space >= 0:
+                    start = space + 1
+            end = min(len(line), cut_end + self.window_overlap)
+            if end < len(line):
+                # end after the last whitespace of the context:
+                space = line.rfind(' ', cut_end, end)
+                if space >= 0:
+                    end = space + 1
+            windows.append((start, end, cut_start, cut_end))
+        return windows
+    
+    def _correct_gated(self, lines, conf=None, fast=True, greedy=True, deadline=None, also_greedy=False):
+        '''apply correction model on text strings (unless confident)
+        
+        See `correct_lines`.
+        '''
+        if (self.passthrough_threshold and conf and
+            not any(is_confmat(line_conf) for line_conf in conf)):
+            return self._correct_uncertain(lines, conf, fast=fast, greedy=greedy, deadline=deadline,
+                                           also_greedy=also_greedy)
+        return self._correct_cached(lines, conf, fast=fast, greedy=greedy, deadline=deadline,
+                                    also_greedy=also_greedy)
+    
+    def _correct_uncertain(self, lines, conf, fast=True, greedy=True, deadline=None, also_greedy=False):
+        '''apply correction model on the uncertain parts of text strings only
+        
+        See `correct_lines`.
+        '''
+        width = 8 if also_greedy else 4
+        spans = [self._get_confident_spans(line, line_conf) if line else [(0, 0, False)]
+                 for line, line_conf in zip(lines, conf)]
+        inputs, inputs_conf = [], []
+        for line, line_conf, line_spans in zip(lines, conf, spans):
+            for start, end, confident in line_spans:
+                if confident:
+                    continue
+                if end < len(line):
+                    # not at the end of the line: add end-of-sequence symbol
+                    inputs.append(line[start:end] + '\n')
+                    inputs_conf.append(list(line_conf[start:end]) + [1.0])
+                else:
+                    inputs.append(line[start:end])
+                    inputs_conf.append(list(line_conf[start:end]))
+        self.logger.debug('passing through %d of %d lines unchanged',
+                          sum(line_spans[0][2] for line_spans in spans if len(line_spans) == 1),
+                          len(lines))
+        results = []
+        if inputs:
+            results = list(zip(*self._correct_cached(inputs, inputs_conf,
+                                                     fast=fast, greedy=greedy, deadline=deadline,
+                                                     also_greedy=also_greedy)))
+        results.reverse() # to pop in order
+        outputs = []
+        for line, line_conf, line_spans in zip(lines, conf, spans):
+            if len(line_spans) == 1 and not line_spans[0][2]:
+                outputs.append(results.pop()) # decoded as a whole
+                continue
+            line_results = [None if confident else results.pop()
+                            for _, _, confident in line_spans]
+            output = ()
+            for k in range(0, width, 4): # beamed and/or greedy
+                pieces = []
+                for (start, end, confident), result in zip(line_spans, line_results):
+                    if confident:
+                        pieces.append((start, end, line[start:end], list(line_conf[start:end]),
+                                       BandedAlignment.identity(end - start, self.alignment_width)))
+                    else:
+                        piece_line, piece_probs, _, piece_alignment = result[k:k + 4]
+                        pieces.append((start, end, piece_line, piece_probs, piece_alignment))
+                output += _join_pieces(len(line), pieces)
+            outputs.append(output)
+        return tuple(map(list, zip(*outputs)))
+    
+    def _get_confident_spans(self, line, conf):
+        '''Split a line into parts with sufficient or insufficient confidence.
+        
+        Compare confidences `conf` of the characters in `line` with
+        `passthrough_threshold`. If `passthrough_spans`, then consider
+        each word (with its trailing whitespace) on its own, otherwise
+        only the line as a whole.
         
+        Return a list of 3-tuples of start and end position, and
+        whether the part is confident.
+        '''
+        if min(conf) >= self.passthrough_threshold:
+            return [(0, len(line), True)]
+        if not self.passthrough_spans:
+            return [(0, len(line), False)]
+        spans = []
+        start = 0
+        for end in [i + 1 for i, char in enumerate(line) if char == ' '] + [len(line)]:
+            if end <= start:
+                continue
+            confident = min(conf[start:end]) >= self.passthrough_threshold
+            if spans and spans[-1][2] == confident:
+                spans[-1] = (spans[-1][0], end, confident)
+            else:
+                spans.append((start, end, confident))
+            start = end
+        return spans
+    
+    def _correct_cached(self, lines, conf=None, fast=True, greedy=True, deadline=None, also_greedy=False):
+        '''apply correction model on text strings (unless cached)
+        
+        See `correct_lines`.
+        '''
+        if self.cache is None:
+            return self._correct_buckets(lines, conf, fast=fast, greedy=greedy, deadline=deadline,
+                                         also_greedy=also_greedy)[:-1]
+        params = (fast, greedy, also_greedy, self.speculative, self.lm_predict,
+                  self.rejection_threshold, self.beam_width_in, self.beam_threshold_in,
+                  self.beam_recombination, self.beam_max_expansions, self.beam_greedy_bound,
+                  self.beam_adaptive,
+                  self.cascade_perplexity, self.cascade_distance, self.alignment_width)
+        results = [None] * len(lines)
+        missing = dict() # line indexes for each key not in cache
+        for j, line in enumerate(lines):
+            if not line:
+                results[j] = ('', [], 0, BandedAlignment.identity(0, self.alignment_width)) * (
+                    2 if also_greedy else 1)
+                continue
+            key = (self.cache.make_key(line, conf[j] if conf else None, self.checksum, params),
+                   len(line))
+            if key in missing:
+                missing[key].append(j)
+                continue
+            value = self.cache.get(key[0])
+            if value is not None and value[0] == len(line):
+                results[j] = value[1:]
+            else:
+                missing[key] = [j]
+        if missing:
+            indexes = [js[0] for js in missing.values()]
+            new_results = self._correct_buckets([lines[j] for j in indexes],
+                                                [conf[j] for j in indexes] if conf else None,
+                                                fast=fast, greedy=greedy, deadline=deadline,
+                                                also_greedy=also_greedy)
+            for ((key, length), js), result in zip(missing.items(), zip(*new_results)):
+                result, exhausted = result[:-1], result[-1]
+                if not exhausted:
+                    self.cache.put(key, (length,) + result)
+                for j in js:
+                    results[j] = result
+            self.cache.flush()
+        return tuple(map(list, zip(*results)))
+    
+    def _correct_buckets(self, lines, conf=None, fast=True, greedy=True, deadline=None, also_greedy=False):
+        '''apply correction model on text strings (in buckets)
+        
+        See `correct_lines`. Return a 5-tuple (or 9-tuple), adding a list
+        of flags whether the search budget was exhausted for each line.
+        '''
+        if not self.bucket_size or len(lines) <= self.bucket_size:
+            return self._correct_lines(lines, conf, fast=fast, greedy=greedy, deadline=deadline,
+                                       also_greedy=also_greedy)
+        order = sorted(range(len(lines)), key=lambda j: len(lines[j]))
+        results = [None] * len(lines)
+        for k in range(0, len(lines), self.bucket_size):
+            bucket = order[k:k + self.bucket_size]
+            bucket_results = self._correct_lines([lines[j] for j in bucket],
+                                                 [conf[j] for j in bucket] if conf else None,
+                                                 fast=fast, greedy=greedy, deadline=deadline,
+                                                 also_greedy=also_greedy)
+            for j, result in zip(bucket, zip(*bucket_results)):
+                results[j] = result
+        # restore original order:
+        return tuple(map(list, zip(*results)))
+    
+    def _correct_lines(self, lines, conf=None, fast=True, greedy=True, deadline=None, also_greedy=False):
+        '''apply correction model on text strings (all lines at once)
+        
+        See `_correct_buckets`.
+        '''
         # vectorize:
-        encoder_input_data, _, _, _ = self.vectorize_lines(lines, lines, conf)
+        encoder_input_data, _, _, _ = self.vectorize_lines(lines, lines, conf, sparse=self.sparse_input)
+        exhausted = [False] * len(lines)
 
-        if fast:
+        if greedy and self.speculative:
+            # encode and verify/decode in batch (all lines at once):
+            output_lines, output_probs, output_scores, alignments = self.decode_batch_speculative(encoder_input_data)
+        elif fast:
             # encode and decode in batch (all lines at once):
             _, output_lines, output_probs, output_scores, alignments = self.decode_batch_greedy(encoder_input_data)
         else:
             # encode lines in batch (all lines at once):
             encoder_outputs = self.encoder_model.predict_on_batch(encoder_input_data)
-            # decode lines and characters individually:
+            cascade = self.cascade_perplexity or self.cascade_distance
+            greedy_first = (greedy or also_greedy or cascade or
+                            self.beam_greedy_bound and not self.lm_predict)
+            if greedy_first:
+                # decode lines greedily in batch (all lines at once):
+                _, greedy_lines, greedy_probs, greedy_scores, greedy_alignments = (
+                    self.decode_batch_greedy(encoder_input_data, encoder_outputs=encoder_outputs))
+            if not greedy:
+                bounds = None
+                if self.beam_greedy_bound and not self.lm_predict:
+                    # get an upper bound for the cost of the beam solution:
+                    bounds = [(line, score * len(line)) if line.endswith('\n') else None
+                              for line, score in zip(greedy_lines, greedy_scores)]
+                if cascade:
+                    # select lines where the greedy solution is not good enough:
+                    beamed = np.array([bool(input_line) and (
+                        not line.endswith('\n') or # did not terminate
+                        self.cascade_perplexity and np.exp(score) > self.cascade_perplexity or
+                        self.cascade_distance and self.aligner.get_levenshtein_distance(
+                            input_line, line) > self.cascade_distance)
+                                       for input_line, line, score in zip(
+                                               lines, greedy_lines, greedy_scores)], dtype=bool)
+                    num_beamed = int(np.count_nonzero(beamed))
+                    num_greedy = len(lines) - lines.count('') - num_beamed
+                    self.cascade_counts['greedy'] += num_greedy
+                    self.cascade_counts['beamed'] += num_beamed
+                    self.logger.debug('cascade: %d lines greedy, %d lines beamed',
+                                      num_greedy, num_beamed)
+                else:
+                    beamed = np.ones(len(lines), dtype=bool)
+                # decode lines in batch (all hypotheses of all lines at once):
+                results = [[] for _ in lines]
+                exhausted = np.zeros(len(lines), dtype=bool)
+                if np.any(beamed):
+                    beamed_results, exhausted[beamed] = self.decode_batch_beam(
+                        encoder_input_data[beamed],
+                        [encoder_output[beamed] for encoder_output in encoder_outputs],
+                        bounds=[bounds[j] for j in np.flatnonzero(beamed)] if bounds else None,
+                        deadline=deadline)
+                    for j, result in zip(np.flatnonzero(beamed), beamed_results):
+                        results[j] = result
+                if np.any(exhausted):
+                    self.exhausted_count += int(np.count_nonzero(exhausted))
+                    self.logger.warning('beam search budget exhausted for %d of %d lines',
+                                        np.count_nonzero(exhausted), len(lines))
+                    if not greedy_first:
+                        # decode exhausted lines greedily now (as fallback):
+                        fallback = np.flatnonzero(exhausted)
+                        greedy_lines, greedy_probs, greedy_scores, greedy_alignments = (
+                            [None] * len(lines) for _ in range(4))
+                        for j, result in zip(fallback, zip(*self.decode_batch_greedy(
+                                encoder_input_data[fallback],
+                                encoder_outputs=[encoder_output[fallback]
+                                                 for encoder_output in encoder_outputs])[1:])):
+                            (greedy_lines[j], greedy_probs[j],
+                             greedy_scores[j], greedy_alignments[j]) = result
+            # collect results of individual lines:
             output_lines, output_probs, output_scores, alignments = [], [], [], []
             for j, input_line in enumerate(lines):
                 if not input_line:
-                    line, probs, score, alignment = '', [], 0, []
-                elif greedy:
-                    line, probs, score, alignment = self.decode_sequence_greedy(
-                        encoder_outputs=[encoder_output[j:j+1] for encoder_output in encoder_outputs])
-                else:
+                    line, probs, score, alignment = '', [], 0, BandedAlignment.identity(
+                        0, self.alignment_width)
+                elif greedy or not beamed[j]:
+                    line, probs, score, alignment = (
+                        greedy_lines[j], greedy_probs[j], greedy_scores[j], greedy_alignments[j])
+                elif results[j]:
                     # query only 1-best
-                    try:
-                        line, probs, score, alignment = next(self.decode_sequence_beam(
-                            source_seq=encoder_input_data[j], # needed for rejection fallback
-                            encoder_outputs=[encoder_output[j:j+1] for encoder_output in encoder_outputs]))
-                    except StopIteration:
-                        self.logger.error('cannot beam-decode input line %d: "%s"', j, input_line)
-                        line = input_line
-                        probs = [1.0] * len(line)
-                        score = 0
-                        alignment = np.eye(len(line)).tolist()
+                    line, probs, score, alignment = results[j][0]
+                elif bounds and bounds[j] or exhausted[j]:
+                    # nothing found below the greedy solution (or in time)
+                    line, probs, score, alignment = (
+                        greedy_lines[j], greedy_probs[j], greedy_scores[j], greedy_alignments[j])
+                else:
+                    self.logger.error('cannot beam-decode input line %d: "%s"', j, input_line)
+                    line = input_line
+                    probs = [1.0] * len(line)
+                    score = 0
+                    alignment = BandedAlignment.identity(len(line), self.alignment_width)
                 output_lines.append(line)
                 output_probs.append(probs)
                 output_scores.append(score)
                 alignments.append(alignment)
-        return output_lines, output_probs, output_scores, alignments
+            if also_greedy:
+                # keep only the actual input positions of the alignments:
+                greedy_alignments = [alignment.crop(len(line))
+                                     for alignment, line in zip(greedy_alignments, lines)]
+                return (output_lines, output_probs, output_scores,
+                        [alignment.crop(len(line)) for alignment, line in zip(alignments, lines)],
+                        greedy_lines, greedy_probs, greedy_scores, greedy_alignments,
+                        list(exhausted))
+        # keep only the actual input positions of the alignments:
+        alignments = [alignment.crop(len(line)) for alignment, line in zip(alignments, lines)]
+        return output_lines, output_probs, output_scores, alignments, list(exhausted)
     
     # for fit_generator()/predict_generator()/evaluate_generator()/standalone
     # -- looping, but not shuffling
@@ -813,8 +1302,12 @@ class Sequence2Sequence(object):
         epoch = 0
         if train and self.scheduled_sampling:
             sample_ratio = 0
-        for batch in self.gen_lines(filenames, True, split, train):
-            if not batch:
+        if isinstance(filenames, CorpusStore):
+            batches = self.gen_store(filenames, split, train)
+        else:
+            batches = self.gen_lines(filenames, True, split, train)
+        for batch in batches:
+            if batch is False:
                 epoch += 1
                 yield False # signal end of epoch to autosized fit/evaluate
                 if train and self.scheduled_sampling:
@@ -832,24 +1325,49 @@ class Sequence2Sequence(object):
                     with self.graph.as_default():
                         self._resync_decoder()
             else:
-                source_lines, target_lines, sourceconf_lines = batch
                 if train and self.scheduled_sampling:
                     line_schedules = np.random.uniform(0, 1, self.batch_size)
                 else:
                     line_schedules = None
                 # vectorize:
-                encoder_input_data, decoder_input_data, decoder_output_data, decoder_output_weights = (
-                    self.vectorize_lines(source_lines, target_lines,
-                                         sourceconf_lines))
+                if isinstance(filenames, CorpusStore):
+                    encoder_input_data, decoder_input_data, decoder_output_data, decoder_output_weights = (
+                        self.vectorize_store(filenames, batch, sparse=self.sparse_input))
+                else:
+                    source_lines, target_lines, sourceconf_lines = batch
+                    encoder_input_data, decoder_input_data, decoder_output_data, decoder_output_weights = (
+                        self.vectorize_lines(source_lines, target_lines,
+                                             sourceconf_lines,
+                                             sparse=self.sparse_input))
                 # yield source/target data to keras consumer loop (fit/evaluate)
-                if line_schedules is not None: # and epoch > 1:
+                if line_schedules is not None and self.sparse_input:
+                    indexes = line_schedules < sample_ratio # respect current schedule
+                    if np.count_nonzero(indexes) > 0:
+                        with self.graph.as_default():
+                            decoder_input_data_sampled, _, _, _, _ = self.decode_batch_greedy(
+                                encoder_input_data, output_data=True)
+                            # zero-fill larger time-steps and more pairs:
+                            length = max(decoder_input_data.shape[1], decoder_input_data_sampled.shape[1])
+                            k = decoder_input_data_sampled.shape[2]
+                            decoder_input_data_sampled = np.pad(decoder_input_data_sampled, (
+                                (0, 0), (0, length - decoder_input_data_sampled.shape[1]), (0, 0), (0, 0)))
+                            decoder_input_data = np.pad(decoder_input_data, (
+                                (0, 0), (0, length - decoder_input_data.shape[1]), (0, k - 1), (0, 0)))
+                            decoder_output_data = np.pad(decoder_output_data, (
+                                (0, 0), (0, length - decoder_output_data.shape[1]), (0, 0)))
+                            decoder_output_weights = np.pad(decoder_output_weights, (
+                                (0, 0), (0, length - decoder_output_weights.shape[1])))
+                            # overwrite scheduled lines with data sampled from decoder instead of GT:
+                            decoder_input_data[indexes] = decoder_input_data_sampled[indexes]
+                elif line_schedules is not None: # and epoch > 1:
                     # calculate greedy/beamed decoder output to yield as as decoder input
                     indexes = line_schedules < sample_ratio # respect current schedule
                     if np.count_nonzero(indexes) > 0:
                         # ensure the generator thread gets to see the same tf graph:
                         # with self.sess.as_default():
                         with self.graph.as_default():
-                            decoder_input_data_sampled, _, _, _, _ = self.decode_batch_greedy(encoder_input_data)
+                            decoder_input_data_sampled, _, _, _, _ = self.decode_batch_greedy(encoder_input_data,
+                                                                                              output_data=True)
                             # overwrite scheduled lines with data sampled from decoder instead of GT:
                             decoder_input_data.resize( # zero-fill larger time-steps (in-place)
                                 decoder_input_data_sampled.shape)
@@ -866,9 +1384,15 @@ class Sequence2Sequence(object):
                     # encoder degradation to index zero for learning character underspecification
                     rand = np.random.uniform(0, 1, self.batch_size)
                     line_length = encoder_input_data[0].shape[0]
-                    rand = (line_length * rand / 0.01).astype(np.int) # effective degradation ratio
-                    encoder_input_data[np.arange(self.batch_size)[rand < line_length],
-                                       rand[rand < line_length], :] = np.eye(self.voc_size)[0]
+                    rand = (line_length * rand / 0.01).astype(int) # effective degradation ratio
+                    if self.sparse_input:
+                        degraded = (np.arange(self.batch_size)[rand < line_length],
+                                    rand[rand < line_length])
+                        encoder_input_data[degraded] = 0
+                        encoder_input_data[degraded + (0, 1)] = 1 # index zero only
+                    else:
+                        encoder_input_data[np.arange(self.batch_size)[rand < line_length],
+                                           rand[rand < line_length], :] = np.eye(self.voc_size)[0]
                 yield ([encoder_input_data, decoder_input_data],
                        decoder_output_data, decoder_output_weights)
                     
@@ -882,6 +1406,9 @@ class Sequence2Sequence(object):
         """
         split_ratio = 0.2
         epoch = 0
+        # compiled confusion networks (and their first-best text)
+        # for each file and line (re-used across epochs):
+        layouts = dict()
         while True:
             source_lines = []
             target_lines = []
@@ -906,9 +1433,12 @@ class Sequence2Sequence(object):
                             elif type(source_text[0]) is tuple: # prob line
                                 source_text, source_conf = map(list, zip(*source_text))
                                 source_text = ''.join(source_text)
+                            elif (filename, line_no) in layouts: # confmat (compiled already)
+                                source_text, source_conf = layouts[filename, line_no]
                             else: # confmat
-                                source_conf = source_text
-                                source_text = ''.join(chunk[0][0] if chunk else '' for chunk in source_conf)
+                                source_conf = self.compile_confmat(source_text)
+                                source_text = ''.join(chunk[0][0] if chunk else '' for chunk in source_text)
+                                layouts[filename, line_no] = source_text, source_conf
                             # start-of-sequence will be added by vectorisation
                             # end-of-sequence already preserved by pickle format
                         else:
@@ -920,7 +1450,10 @@ class Sequence2Sequence(object):
                         source_text = unicodedata.normalize('NFC', source_text)
                         target_text = unicodedata.normalize('NFC', target_text)
 
-                        if train:
+                        if train and self.line_filter and os.path.abspath(filename) in self.line_filter:
+                            if line_no in self.line_filter[os.path.abspath(filename)]:
+                                continue # recorded as bad already
+                        elif train:
                             # align source and target text line:
                             self.aligner.set_seqs(source_text, target_text)
                             if self.aligner.is_bad():
@@ -956,7 +1489,30 @@ class Sequence2Sequence(object):
                            sourceconf_lines if with_confidence else None)
                 break
     
-    def vectorize_lines(self, encoder_input_sequences, decoder_input_sequences, encoder_conf_sequences=None):
+    def gen_store(self, store, split=None, train=False):
+        """Generate batches of line numbers from a compiled corpus.
+        
+        Like `gen_lines` (repeating), but take lines from `store`
+        (a `CorpusStore`), skipping lines marked bad there during training,
+        and yield arrays of line numbers (for `vectorize_store`).
+        """
+        split_ratio = 0.2
+        lines = np.arange(len(store))
+        if isinstance(split, np.ndarray):
+            # data shared between training and validation: belongs to other generator, resp.
+            lines = lines[(split < split_ratio) != train]
+        if train:
+            bad = np.asarray(store.bad[lines])
+            self.logger.debug('ignoring %d bad lines', np.count_nonzero(bad))
+            lines = lines[~bad] # avoid training if OCR was too bad
+        while True:
+            for start in range(0, len(lines) - self.batch_size + 1, self.batch_size):
+                yield lines[start:start + self.batch_size]
+            yield False
+            # bury remaining lines (partially filled batch)
+    
+    def vectorize_lines(self, encoder_input_sequences, decoder_input_sequences, encoder_conf_sequences=None,
+                        sparse=False):
         '''Convert a batch of source and target sequences to arrays.
         
         Take the given (line) lists of encoder and decoder input strings,
@@ -971,84 +1527,140 @@ class Sequence2Sequence(object):
         strings themselves), or full confusion networks, where every line
         is a list of chunks, and each chunk is a list of alternatives, which
         is a tuple of a string and its probability. (Chunks/alternatives may
-        have different length.)
+        have different length.) Confusion networks can also be passed
+        in the compiled form of `compile_confmat`.
         
         Special cases:
         - true zero (no index): padding for encoder and decoder (masked),
                                 and start "symbol" for decoder input
         - empty character (index zero): underspecified encoder input
                                         (not allowed in decoder)
+        
+        If `sparse`, then represent each vector by index/probability pairs
+        instead (see `sparse_input`), giving numpy arrays of shape
+        (batch_size, max_length, k, 2) for encoder and decoder input,
+        and indexes of shape (batch_size, max_length, 1) for decoder output.
+        (Padding gets index zero and probability zero, or weight zero.)
         '''
-        # Note: padding and confidence indexing need Dense/dot instead of Embedding/gather.
+        # Note: padding and confidence indexing need Dense/dot (or index/probability pairs)
+        # instead of Embedding/gather.
         # Used both for training (teacher forcing) and inference (ignore decoder input/output/weights).
         max_encoder_input_length = max(map(len, encoder_input_sequences))
-        max_decoder_input_length = max(map(len, decoder_input_sequences))
         assert len(encoder_input_sequences) == len(decoder_input_sequences)
         batch_size = len(encoder_input_sequences)
         with_confmat = False
         if encoder_conf_sequences:
             assert len(encoder_conf_sequences) == len(encoder_input_sequences)
-            if type(encoder_conf_sequences[0][0]) is list:
+            if any(is_confmat(sequence) for sequence in encoder_conf_sequences):
                 with_confmat = True
-                max_encoder_input_length = max(
-                    [sum(max([len(x[0]) for x in chunk]) if chunk else 0
-                         for chunk in sequence)
-                     for sequence in encoder_conf_sequences])
-                encoder_input_sequences = encoder_conf_sequences
-        encoder_input_data  = np.zeros((batch_size, max_encoder_input_length, self.voc_size),
-                                       dtype=np.float32 if encoder_conf_sequences else np.uint32)
-        decoder_input_data  = np.zeros((batch_size, max_decoder_input_length+1, self.voc_size),
-                                       dtype=np.uint32)
-        decoder_output_data = np.zeros((batch_size, max_decoder_input_length+1, self.voc_size),
-                                       dtype=np.uint32)
-        for i, (enc_seq, dec_seq) in enumerate(zip(encoder_input_sequences, decoder_input_sequences)):
-            j = 0 # to declare scope outside loop
-            if with_confmat:
-                for chunk in enc_seq:
-                    max_chars = max([len(x[0]) for x in chunk]) if chunk else 0
-                    for chars, conf in chunk:
-                        for k, char in enumerate(chars):
-                            if char not in self.mapping[0]:
-                                if char != GAP:
-                                    self.logger.error('unmapped character "%s" at encoder input sequence %d position %d',
-                                                      char, i, j+k)
-                                idx = 0 # underspecification
-                            else:
-                                idx = self.mapping[0][char]
-                            encoder_input_data[i, j+k, idx] = conf
-                        # ...other k for input: padding (keep zero)
-                    j += max_chars
-                # ...other j for input: padding (keep zero)
+                layouts = [sequence if isinstance(sequence, tuple) else self.compile_confmat(sequence)
+                           for sequence in encoder_conf_sequences]
+                max_encoder_input_length = max(layout[0] for layout in layouts)
+        if with_confmat:
+            rows = np.repeat(np.arange(batch_size), [len(layout[1]) for layout in layouts])
+            cols = np.concatenate([layout[1] for layout in layouts])
+            idxs = np.concatenate([layout[2] for layout in layouts])
+            values = np.concatenate([layout[3] for layout in layouts])
+        else:
+            rows, cols, idxs, _ = self._map_lines(encoder_input_sequences, 'encoder input')
+            if encoder_conf_sequences: # binary input with OCR confidence?
+                values = np.concatenate(
+                    [np.asarray(conf[:len(sequence)], dtype=np.float32)
+                     for sequence, conf in zip(encoder_input_sequences, encoder_conf_sequences)])
             else:
-                for j, char in enumerate(enc_seq):
-                    if char not in self.mapping[0]:
-                        if char != GAP:
-                            self.logger.error('unmapped character "%s" at encoder input sequence %d', char, i)
-                        idx = 0 # underspecification
-                    else:
-                        idx = self.mapping[0][char]
-                    encoder_input_data[i, j, idx] = 1
-                    if encoder_conf_sequences: # binary input with OCR confidence?
-                        encoder_input_data[i, j, idx] = encoder_conf_sequences[i][j]
-                # ...other j for encoder input: padding (keep zero)
-            # j == 0 for decoder input: start symbol (keep zero)
-            for j, char in enumerate(dec_seq):
-                if char not in self.mapping[0]:
-                    if char != GAP:
-                        self.logger.error('unmapped character "%s" at decoder input sequence %d', char, i)
-                    idx = 0
-                else:
-                    idx = self.mapping[0][char]
-                decoder_input_data[i, j+1, idx] = 1
-                # teacher forcing:
-                decoder_output_data[i, j, idx] = 1
-            # j == len(dec_seq) for decoder output: padding (keep zero)
-            # ...other j for decoder input and output: padding (keep zero)
+                values = 1
+        return self._vectorize_indexes(
+            max_encoder_input_length, (rows, cols, idxs, values),
+            self._map_lines(decoder_input_sequences, 'decoder input'),
+            with_conf=bool(encoder_conf_sequences), with_confmat=with_confmat, sparse=sparse)
+    
+    def vectorize_store(self, store, lines, sparse=False):
+        '''Convert a batch of lines from a compiled corpus to arrays.
+        
+        Like `vectorize_lines`, but take the line numbers `lines` of
+        `store` (a `CorpusStore`), and gather their character indexes
+        (and probabilities or confusion networks, if any) directly from
+        its (memory-mapped) arrays, re-mapping them to our own indexes.
+        '''
+        lookup = np.array([self.mapping[0].get(char, 0) # GAP or unmapped: underspecification
+                           for char in store.chars], dtype=np.int64)
+        if store.confidence == 'confmat':
+            rows, _, flat, _ = gather_lines(store.confmat_offsets, lines)
+            cols = store.confmat_positions[flat]
+            idxs = lookup[store.confmat_indexes[flat]]
+            values = store.confmat_probs[flat]
+            max_encoder_input_length = int(store.confmat_lengths[lines].max(initial=0))
+        else:
+            rows, cols, flat, lengths = gather_lines(store.source_offsets, lines)
+            idxs = lookup[store.source[flat]]
+            if store.confidence == 'probs':
+                values = store.source_conf[flat]
+            else:
+                values = 1
+            max_encoder_input_length = int(lengths.max(initial=0))
+        decoder_rows, decoder_cols, flat, lengths = gather_lines(store.target_offsets, lines)
+        return self._vectorize_indexes(
+            max_encoder_input_length, (rows, cols, idxs, values),
+            (decoder_rows, decoder_cols, lookup[store.target[flat]], lengths),
+            with_conf=bool(store.confidence), with_confmat=store.confidence == 'confmat', sparse=sparse)
+    
+    def _vectorize_indexes(self, max_encoder_input_length, encoder_indexes, decoder_indexes,
+                           with_conf=False, with_confmat=False, sparse=False):
+        '''Scatter mapped characters into arrays (for `vectorize_lines` and `vectorize_store`).
+        
+        Take `encoder_indexes`, a 4-tuple of flat arrays of line number,
+        position and index of all characters, and their values, and
+        `decoder_indexes`, a 4-tuple of line number, position and index,
+        and an array of line lengths (cf. `_map_lines`).
+        '''
+        rows, cols, idxs, values = encoder_indexes
+        decoder_rows, decoder_cols, decoder_idxs, lengths = decoder_indexes
+        batch_size = len(lengths)
+        max_decoder_input_length = int(lengths.max(initial=0))
+        if sparse:
+            # index/probability pairs instead of vectors:
+            encoder_input_data  = np.zeros((batch_size, max_encoder_input_length,
+                                            min(self.sparse_topk, self.voc_size) if with_confmat else 1, 2),
+                                           dtype=np.float32)
+            decoder_input_data  = np.zeros((batch_size, max_decoder_input_length+1, 1, 2),
+                                           dtype=np.float32)
+            decoder_output_data = np.zeros((batch_size, max_decoder_input_length+1, 1),
+                                           dtype=np.int32)
+        else:
+            encoder_input_data  = np.zeros((batch_size, max_encoder_input_length, self.voc_size),
+                                           dtype=np.float32 if with_conf else np.uint32)
+            decoder_input_data  = np.zeros((batch_size, max_decoder_input_length+1, self.voc_size),
+                                           dtype=np.uint32)
+            decoder_output_data = np.zeros((batch_size, max_decoder_input_length+1, self.voc_size),
+                                           dtype=np.uint32)
+        if with_confmat and sparse:
+            rows, cols, ranks, idxs, values = self._rank_alternatives(
+                rows, cols, idxs, values, encoder_input_data.shape[2])
+            encoder_input_data[rows, cols, ranks, 0] = idxs
+            encoder_input_data[rows, cols, ranks, 1] = values
+        elif sparse:
+            encoder_input_data[rows, cols, 0, 0] = idxs
+            encoder_input_data[rows, cols, 0, 1] = values
+        else:
+            encoder_input_data[rows, cols, idxs] = values
+        # ...other j for encoder input: padding (keep zero)
+        # j == 0 for decoder input: start symbol (keep zero)
+        if sparse:
+            decoder_input_data[decoder_rows, decoder_cols + 1, 0, 0] = decoder_idxs
+            decoder_input_data[decoder_rows, decoder_cols + 1, 0, 1] = 1
+            # teacher forcing (sparse targets):
+            decoder_output_data[decoder_rows, decoder_cols, 0] = decoder_idxs
+        else:
+            decoder_input_data[decoder_rows, decoder_cols + 1, decoder_idxs] = 1
+            # teacher forcing:
+            decoder_output_data[decoder_rows, decoder_cols, decoder_idxs] = 1
+        # j == len(dec_seq) for decoder output: padding (keep zero)
+        # ...other j for decoder input and output: padding (keep zero)
         
         # index of padded samples, so we can mask them
         # with the sample_weight parameter during fit() below
-        decoder_output_weights = np.ones(decoder_output_data.shape[:-1], dtype=np.float32)
-        decoder_output_weights[np.all(decoder_output_data == 0, axis=2)] = 0. # true zero (padding)
+        decoder_output_weights = (np.arange(max_decoder_input_length+1) <
+                                  lengths[:, np.newaxis]).astype(np.float32) # true zero (padding)
         #sklearn.preprocessing.normalize(decoder_output_weights, norm='l1', copy=False) # since Keras 2.3
         if self.lm_loss:
             # 2 outputs, 1 combined loss:
@@ -1057,6 +1669,146 @@ class Sequence2Sequence(object):
         
         return encoder_input_data, decoder_input_data, decoder_output_data, decoder_output_weights
     
+    def compile_confmat(self, confmat):
+        '''Flatten a confusion network into a compact layout for `vectorize_lines`.
+        
+        Take `confmat`, a list of chunks, where each chunk is a list of
+        alternatives, which is a tuple of a string and its probability,
+        and map all characters to indexes at once. Characters of all
+        alternatives of a chunk start at the same position, and the next
+        chunk starts after the longest alternative.
+        
+        Return a 4-tuple of the length, and arrays of position, index
+        and probability for each character (keeping only the last
+        alternative for the same position and index). This can be passed
+        to `vectorize_lines` in place of `confmat` (e.g. to re-use it
+        across epochs).
+        '''
+        length, text, positions, probs = flatten_confmat(confmat)
+        idxs = self._map_chars(text)
+        for k in np.flatnonzero(idxs < 0):
+            if text[k] != GAP:
+                self.logger.error('unmapped character "%s" at encoder input position %d',
+                                  text[k], positions[k])
+        idxs[idxs < 0] = 0 # underspecification
+        # last alternative wins (as if assigned in turn):
+        _, last = np.unique((positions * (idxs.max(initial=0) + 1) + idxs)[::-1], return_index=True)
+        last = len(text) - 1 - last
+        return length, positions[last].astype(np.int32), idxs[last], probs[last]
+    
+    def _map_chars(self, chars):
+        '''Map string `chars` to an array of indexes (-1 for unmapped characters).
+        
+        Look up all characters at once, using a table from codepoints
+        to indexes (compiled from `mapping` on first use).
+        '''
+        if self.char_lookup is None or self.char_lookup[0] is not self.mapping[0] or (
+                self.char_lookup[1] != len(self.mapping[0])):
+            codes = dict((ord(char), idx) for char, idx in self.mapping[0].items() if len(char) == 1)
+            # (with an extra entry for all codepoints beyond)
+            table = np.full(max(codes, default=0) + 2, -1, dtype=np.int32)
+            table[list(codes.keys())] = list(codes.values())
+            self.char_lookup = (self.mapping[0], len(self.mapping[0]), table)
+        table = self.char_lookup[2]
+        codes = np.frombuffer(chars.encode('utf-32-le'), dtype=np.uint32)
+        return table[np.minimum(codes, len(table) - 1)]
+    
+    def _map_lines(self, sequences, name):
+        '''Map strings `sequences` to indexes (for scattering into arrays).
+        
+        Return a 4-tuple of flat arrays of line number, position and
+        index for all characters, and an array of line lengths.
+        Unmapped characters (logged as errors, except for `GAP`)
+        get index zero (underspecification).
+        '''
+        lengths = np.array([len(sequence) for sequence in sequences], dtype=np.int64)
+        text = ''.join(sequences)
+        idxs = self._map_chars(text)
+        rows = np.repeat(np.arange(len(sequences)), lengths)
+        cols = np.arange(len(text)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        for k in np.flatnonzero(idxs < 0):
+            if text[k] != GAP:
+                self.logger.error('unmapped character "%s" at %s sequence %d', text[k], name, rows[k])
+        idxs[idxs < 0] = 0 # underspecification
+        return rows, cols, idxs, lengths
+    
+    def _rank_alternatives(self, rows, cols, idxs, values, k):
+        '''Select the `k` largest alternatives at each position (for sparse confusion networks).
+        
+        Take flat arrays of line number, position, index and value of
+        all characters. For the same line, position and index, keep only
+        the last value (as if assigned in turn). Then rank the remaining
+        characters at each line and position by their value.
+        
+        Return a 5-tuple of flat arrays of line number, position, rank,
+        index and value for the characters ranked below `k`.
+        '''
+        values = np.broadcast_to(np.asarray(values, dtype=np.float32), idxs.shape)
+        # last alternative wins (as if assigned in turn):
+        keys = (rows * (cols.max(initial=0) + 1) + cols) * self.voc_size + idxs
+        _, last = np.unique(keys[::-1], return_index=True)
+        last = len(keys) - 1 - last
+        rows, cols, idxs, values = rows[last], cols[last], idxs[last], values[last]
+        # sort by position, then by decreasing value:
+        order = np.lexsort((-values, cols, rows))
+        rows, cols, idxs, values = rows[order], cols[order], idxs[order], values[order]
+        starts = np.flatnonzero(np.diff(rows, prepend=-1) | np.diff(cols, prepend=-1))
+        ranks = np.arange(len(rows)) - np.repeat(starts, np.diff(np.append(starts, len(rows))))
+        keep = ranks < k
+        return rows[keep], cols[keep], ranks[keep], idxs[keep], values[keep]
+    
+    def _input_sparse(self, data):
+        '''Convert input vectors to index/probability pairs (for `sparse_input`).
+        
+        Keep only the `sparse_topk` largest entries of each vector in `data`
+        (of shape (..., voc_size)), and return an array of shape (..., k, 2).
+        '''
+        k = min(self.sparse_topk, data.shape[-1])
+        idxs = np.argpartition(-data, k - 1, axis=-1)[..., :k]
+        values = np.take_along_axis(data, idxs, axis=-1)
+        return np.stack([idxs, values], axis=-1).astype(np.float32)
+    
+    def _input_dense(self, data):
+        '''Convert index/probability pairs back to input vectors (for `sparse_input`).'''
+        dense = np.zeros(data.shape[:-2] + (self.voc_size,), dtype=np.float32)
+        idxs = data[..., 0].astype(int)
+        np.add.at(dense, tuple(np.indices(idxs.shape)[:-1]) + (idxs,), data[..., 1])
+        return dense
+    
+    def _input_zeros(self, shape, dtype=np.float32):
+        '''Get an all-zero input array (for start symbol or padding) of `shape`
+        (plus input dimensions: vectors, or `sparse_topk` index/probability pairs).'''
+        if self.sparse_input:
+            return np.zeros(shape + (min(self.sparse_topk, self.voc_size), 2), dtype=np.float32)
+        return np.zeros(shape + (self.voc_size,), dtype=dtype)
+    
+    def _input_units(self, idxs):
+        '''Get input unit vectors (or index/probability pairs) for indexes `idxs`
+        (with index zero meaning padding, i.e. true zero).'''
+        data = self._input_zeros(idxs.shape)
+        if self.sparse_input:
+            data[..., 0, 0] = idxs
+            data[..., 0, 1] = idxs > 0
+        else:
+            data[np.nonzero(idxs) + (idxs[np.nonzero(idxs)],)] = 1
+        return data
+    
+    def _input_scores(self, scores):
+        '''Get decoder input for feeding back output `scores`
+        (as is, or as the `sparse_topk` largest index/probability pairs).'''
+        if self.sparse_input:
+            return self._input_sparse(scores)
+        return scores
+    
+    def _input_top(self, data):
+        '''Get the index and value of the largest entry at each position of input `data`
+        (vectors, or index/probability pairs with `sparse_input`).'''
+        if self.sparse_input:
+            best = np.argmax(data[..., 1], axis=-1)[..., np.newaxis, np.newaxis]
+            top = np.take_along_axis(data, best, axis=-2)[..., 0, :]
+            return top[..., 0].astype(int), top[..., 1]
+        return np.argmax(data, axis=-1), np.max(data, axis=-1)
+    
     def save(self, filename):
         '''Save model weights and configuration parameters.
 
@@ -1110,6 +1862,7 @@ class Sequence2Sequence(object):
         self.logger.info('Loading model from "%s"', filename)
         self.encoder_decoder_model.load_weights(filename, by_name=True)
         self._resync_decoder()
+        self.checksum = file_checksum(filename)
         self.status = 2
     
     def load_transfer_weights(self, filename):
@@ -1151,55 +1904,80 @@ class Sequence2Sequence(object):
             self._resync_decoder()
         self.status = 1
         
-    def decode_batch_greedy(self, encoder_input_data):
+    def decode_batch_greedy(self, encoder_input_data, encoder_outputs=None, output_data=False):
         '''Predict from one batch of lines array without alternatives.
         
         Use encoder input lines array `encoder_input_data` (in a full batch)
         to produce some encoder output to attend to.
+        If `encoder_outputs` is given, then bypass that step.
         
         Start decoder with start-of-sequence, then keep decoding until
         end-of-sequence is found or output length is way off.
         Decode by using the full output distribution as next input.
         Pass decoder initial/final states from character to character.
+        Decode only lines which have not ended yet (and are not empty),
+        so the batch shrinks as lines finish. (Each line gets the same
+        result as with `decode_sequence_greedy`.)
         
-        Return a 5-tuple of the full output array (for training phase),
+        Return a 5-tuple of the full output array (for training phase,
+        only if `output_data`, otherwise None),
         output strings, output probability lists, entropies, and soft
-        alignments (input-output matrices as list of list of vectors).
+        alignments (as list of `BandedAlignment`).
         '''
         
-        encoder_outputs = self.encoder_model.predict_on_batch(encoder_input_data)
-        encoder_output_data = encoder_outputs[0]
-        states_values = encoder_outputs[1:]
+        if encoder_outputs is None:
+            encoder_outputs = self.encoder_model.predict_on_batch(encoder_input_data)
         batch_size = encoder_input_data.shape[0]
         batch_length = encoder_input_data.shape[1]
-        decoder_input_data = np.zeros((batch_size, 1, self.voc_size), dtype=np.uint32)
-        decoder_output_data = np.zeros((batch_size, batch_length * 2, self.voc_size), dtype=np.uint32)
+        # lines still being decoded (not empty and not ended yet):
+        lines = np.flatnonzero(np.any(self._input_top(encoder_input_data)[1], axis=1))
+        encoder_output_data = encoder_outputs[0][lines]
+        states_values = [state[lines] for state in encoder_outputs[1:]]
+        decoder_input_data = self._input_zeros((len(lines), 1), dtype=np.uint32)
+        if output_data:
+            decoder_output_data = self._input_zeros((batch_size, batch_length * 2), dtype=np.uint32)
+        else:
+            decoder_output_data = None
         decoder_output_sequences = [''] * batch_size
         decoder_output_probs = [[] for _ in range(batch_size)]
         decoder_output_scores = [0.] * batch_size
         #decoder_output_alignments = [[]] * batch_size # does not copy!!
         decoder_output_alignments = [[] for _ in range(batch_size)]
         for i in range(batch_length * 2):
-            decoder_output_data[:, i] = decoder_input_data[:, -1]
+            if not len(lines):
+                break
+            if output_data:
+                decoder_output_data[lines, i] = decoder_input_data[:, -1]
             output = self.decoder_model.predict_on_batch(
                 [decoder_input_data, encoder_output_data] + states_values)
             scores = output[0]
-            states_values = list(output[1:])
-            alignment = states_values[-1]
+            if self.lm_predict:
+                states_values = list(output[2:])
+            else:
+                states_values = list(output[1:])
+            # keep only the band of the alignment around the attention focus:
+            offsets, bands = _band(states_values[-1], self.alignment_width)
             indexes = np.nanargmax(scores[:, :, 1:], axis=2) # without index zero (underspecification)
             #decoder_input_data = np.eye(self.voc_size, dtype=np.uint32)[indexes+1] # unit vectors
-            decoder_input_data = scores # soft/confidence input (much better)
+            decoder_input_data = self._input_scores(scores) # soft/confidence input (much better)
             logscores = -np.log(scores)
-            for j, idx in enumerate(indexes[:, -1] + 1):
-                if decoder_output_sequences[j].endswith('\n') or not np.any(encoder_input_data[j]):
-                    continue
+            for k, (j, idx) in enumerate(zip(lines, indexes[:, -1] + 1)):
                 decoder_output_sequences[j] += self.mapping[1][idx]
-                decoder_output_probs[j].append(scores[j, -1, idx])
-                decoder_output_scores[j] += logscores[j, -1, idx]
-                decoder_output_alignments[j].append(alignment[j])
+                decoder_output_probs[j].append(scores[k, -1, idx])
+                decoder_output_scores[j] += logscores[k, -1, idx]
+                decoder_output_alignments[j].append((offsets[k], bands[k]))
+            # shrink batch to the lines which have not ended yet:
+            keep = np.array([not decoder_output_sequences[j].endswith('\n') for j in lines], dtype=bool)
+            if not np.all(keep):
+                lines = lines[keep]
+                encoder_output_data = encoder_output_data[keep]
+                states_values = [state[keep] for state in states_values]
+                decoder_input_data = decoder_input_data[keep]
         for j in range(batch_size):
             if decoder_output_sequences[j]:
                 decoder_output_scores[j] /= len(decoder_output_sequences[j])
+            decoder_output_alignments[j] = BandedAlignment.from_steps(
+                decoder_output_alignments[j], self.alignment_width, encoder_outputs[0].shape[1])
         # # calculate rejection scores (decoder input = encoder input):
         # decoder_input_data = np.insert(encoder_input_data, 0, 0., axis=1) # add start-of-sequence
         # decoder_rej_sequences = [''] * batch_size
@@ -1224,6 +2002,140 @@ class Sequence2Sequence(object):
                 decoder_output_sequences, decoder_output_probs,
                 decoder_output_scores, decoder_output_alignments)
     
+    def decode_batch_speculative(self, source_data, encoder_outputs=None):
+        '''Predict from one batch of lines array without alternatives, using the input as draft.
+        
+        Use encoder input lines array `source_data` (in a full batch)
+        to produce some encoder output to attend to.
+        If `encoder_outputs` is given, then bypass that step.
+        
+        Take the remaining input characters of each line as a draft for
+        its output, and verify them all at once by feeding them to the
+        decoder as if they had been decoded already (teacher forcing).
+        Accept the longest prefix where the best prediction equals the
+        input character with a probability of at least `rejection_threshold`
+        (and align each of its characters with its input position).
+        From the first disagreement, decode greedily (as in
+        `decode_batch_greedy`), until the output character equals the
+        input character at the current alignment position again. Then
+        continue with the rest of the input as the next draft.
+        
+        Search all lines in lockstep, so all drafts and all greedy
+        steps of one iteration share decoder calls, respectively.
+        
+        Note: the draft is fed back as hard (unit) vectors, whereas
+        `decode_batch_greedy` feeds back the soft output scores, so
+        the results can differ from plain greedy decoding.
+        
+        Return a 4-tuple of output strings, output probability lists,
+        entropies, and soft alignments (as list of `BandedAlignment`).
+        '''
+        
+        if encoder_outputs is None:
+            encoder_outputs = self.encoder_model.predict_on_batch(source_data)
+        attended_data = encoder_outputs[0]
+        attended_len = attended_data.shape[1]
+        states_values = [np.array(state) for state in encoder_outputs[1:]]
+        batch_size = source_data.shape[0]
+        # the input characters (index zero for underspecification):
+        source_idx, source_top = self._input_top(source_data)
+        # length of each line without padding (true zero):
+        source_lens = np.count_nonzero(source_top, axis=1)
+        decoder_input_data = self._input_zeros((batch_size,))
+        output_sequences = [''] * batch_size
+        output_probs = [[] for _ in range(batch_size)]
+        output_scores = [0.] * batch_size
+        output_alignments = [[] for _ in range(batch_size)]
+        
+        def append(j, idx, prob, alignment):
+            output_sequences[j] += self.mapping[1][idx]
+            output_probs[j].append(prob)
+            output_scores[j] -= np.log(prob)
+            output_alignments[j].append(alignment)
+            if (output_sequences[j].endswith('\n') or
+                len(output_sequences[j]) >= 2 * source_lens[j]):
+                active[j] = False
+        def step(lines, scores, states):
+            # one greedy step (from the last timestep of the decoder output)
+            scores = scores[:, -1]
+            for state, layer in zip(states_values, states):
+                state[lines] = layer
+            decoder_input_data[lines] = self._input_scores(scores)
+            indexes = np.nanargmax(scores[:, 1:], axis=1) + 1 # without index zero (underspecification)
+            offsets, bands = _band(states[-1], self.alignment_width)
+            source_pos = (offsets + np.matmul(bands, np.arange(self.alignment_width))).round().astype(int)
+            for i, (j, idx) in enumerate(zip(lines, indexes)):
+                append(j, idx, scores[i, idx], (offsets[i], bands[i]))
+                # back in sync with the input?
+                if (source_pos[i] < source_lens[j] and
+                    source_idx[j, source_pos[i]] == idx):
+                    drafted[j] = source_pos[i] + 1
+                else:
+                    drafted[j] = -1
+        def predict(lines, inputs):
+            output = self.decoder_model.predict_on_batch(
+                [inputs, attended_data[lines]] + [state[lines] for state in states_values])
+            if self.lm_predict:
+                return output[0], list(output[2:])
+            return output[0], list(output[1:])
+        
+        active = source_lens > 0
+        # input position of the next draft for each line (or -1 if out of sync):
+        drafted = np.zeros(batch_size, dtype=np.int32)
+        while np.any(active):
+            syncing = np.flatnonzero(active & (drafted < 0))
+            drafting = np.flatnonzero(active & (drafted >= 0) & (drafted < source_lens))
+            # lines with no input left must be decoded step by step:
+            syncing = np.union1d(syncing, np.flatnonzero(active & (drafted >= source_lens)))
+            if len(syncing):
+                scores, states = predict(syncing, decoder_input_data[syncing, np.newaxis])
+                step(syncing, scores, states)
+            if not len(drafting):
+                continue
+            # verify the rest of the input as draft (all positions at once):
+            draft_lens = source_lens[drafting] - drafted[drafting]
+            draft_idx = np.zeros((len(drafting), np.max(draft_lens)), dtype=np.int32)
+            for i, j in enumerate(drafting):
+                draft_idx[i, :draft_lens[i]] = source_idx[j, drafted[j]:source_lens[j]]
+            # (1 more step than needed for verification, so we can
+            #  also re-run completely accepted drafts below)
+            draft_inputs = self._input_zeros((len(drafting), draft_idx.shape[1] + 1))
+            draft_inputs[:, 0] = decoder_input_data[drafting]
+            # teacher forcing with unit vectors (as in training),
+            # index zero for padding (true zero):
+            draft_inputs[:, 1:] = self._input_units(draft_idx)
+            scores, _ = predict(drafting, draft_inputs[:, :-1])
+            draft_probs = np.take_along_axis(scores, draft_idx[:, :, np.newaxis], axis=2)[:, :, 0]
+            agreed = ((np.nanargmax(scores[:, :, 1:], axis=2) + 1 == draft_idx) &
+                      (draft_probs >= self.rejection_threshold) &
+                      (draft_idx > 0))
+            # length of the accepted prefix:
+            accepted = np.where(np.all(agreed, axis=1), draft_idx.shape[1], np.argmin(agreed, axis=1))
+            accepted = np.minimum(accepted, draft_lens)
+            rejected = {}
+            for i, j in enumerate(drafting):
+                for k in range(accepted[i]):
+                    if not active[j]:
+                        break
+                    append(j, draft_idx[i, k], draft_probs[i, k],
+                           _one_hot_band(drafted[j] + k, self.alignment_width, attended_len))
+                if active[j]:
+                    # first disagreement: re-run the accepted prefix below
+                    rejected.setdefault(accepted[i], []).append(i)
+                    drafted[j] += accepted[i]
+            # get states after the accepted prefix, and decode the next character
+            # (one call for all lines with the same prefix length):
+            for length, rows in rejected.items():
+                lines = drafting[rows]
+                scores, states = predict(lines, draft_inputs[rows, :length + 1])
+                step(lines, scores, states)
+        for j in range(batch_size):
+            if output_sequences[j]:
+                output_scores[j] /= len(output_sequences[j])
+            output_alignments[j] = BandedAlignment.from_steps(
+                output_alignments[j], self.alignment_width, attended_len)
+        return output_sequences, output_probs, output_scores, output_alignments
+    
     def decode_sequence_greedy(self, source_seq=None, encoder_outputs=None):
         '''Predict from one line vector without alternatives.
         
@@ -1247,7 +2159,7 @@ class Sequence2Sequence(object):
         states_values = encoder_outputs[1:]
         
         # Generate empty target sequence of length 1.
-        target_seq = np.zeros((1, 1, self.voc_size), dtype=np.uint32)
+        target_seq = self._input_zeros((1, 1), dtype=np.uint32)
         # The first character (start symbol) stays empty.
         
         # Sampling loop for a batch of sequences
@@ -1257,7 +2169,8 @@ class Sequence2Sequence(object):
         decoded_score = 0
         alignments = []
         for i in range(attended_seq.shape[1] * 2):
-            output = self.decoder_model.predict_on_batch([target_seq, attended_seq] + states_values)
+            output = self.decoder_model.predict_on_batch(
+                [target_seq, attended_seq] + states_values)
             scores = output[0]
             if self.lm_predict:
                 states = output[2:]
@@ -1285,7 +2198,7 @@ class Sequence2Sequence(object):
             
             # Update the target sequence (of length 1):
             #target_seq = np.eye(self.voc_size, dtype=np.uint32)[[[[idx]]]]
-            target_seq = scores # soft/confidence input (better)
+            target_seq = self._input_scores(scores) # soft/confidence input (better)
             # Update states:
             states_values = list(states)
         
@@ -1299,6 +2212,22 @@ class Sequence2Sequence(object):
         to produce some encoder output to attend to.
         If `encoder_outputs` is given, then bypass that step.
         
+        Search like `decode_batch_beam`, but for a single line only.
+        
+        For each solution, yield a 4-tuple of output string, output probabilities,
+        entropy, and soft alignment (as `BandedAlignment`).
+        '''
+        results, _ = self.decode_batch_beam(np.expand_dims(source_seq, axis=0),
+                                            encoder_outputs=encoder_outputs)
+        yield from results[0]
+    
+    def decode_batch_beam(self, source_data, encoder_outputs=None, bounds=None, deadline=None):
+        '''Predict from one batch of lines array with alternatives.
+        
+        Use encoder input lines array `source_data` (in a full batch)
+        to produce some encoder output to attend to.
+        If `encoder_outputs` is given, then bypass that step.
+        
         Start decoder with start-of-sequence, then keep decoding until
         end-of-sequence is found or output length is way off, repeatedly.
         Decode by using the best predicted output characters and several next-best
@@ -1308,188 +2237,533 @@ class Sequence2Sequence(object):
         breadth-first search, with N equal `batch_size`.
         Pass decoder initial/final states from character to character,
         for each candidate respectively.
-        Reserve 1 candidate per iteration for running through `source_seq`
+        Reserve 1 candidate per iteration for running through `source_data`
         (as a rejection fallback) to ensure that path does not fall off the
         beam and at least one solution can be found within the search limits.
         
-        For each solution, yield a 4-tuple of output string, output probabilities,
-        entropy, and soft alignment (input-output matrix as list of vectors).
+        Search all lines in lockstep: in each iteration, stack the fringes
+        of all lines which are still active into one shared decoder batch
+        (of up to `beam_batch_size` hypotheses per call), each hypothesis
+        attending to the (padded) encoder output of its own line. Limit the
+        search of each line by its own length (without padding).
+        
+        Keep decoder states and outputs in a `StatePool` (shared by all
+        hypotheses of the same decoder step), so hypotheses only need to
+        refer to rows there.
+        
+        If `beam_adaptive`, then narrow the number of new candidates for
+        each hypothesis according to the uncertainty at the current step
+        (the lower the input confidence at the estimated source position
+        and the higher the entropy of the output, the wider the beam).
+        
+        If `beam_recombination` is non-zero, then merge hypotheses of the
+        same line which agree in their output suffix (of that length) and
+        estimated source position, keeping only the one with lower
+        prospective cost.
+        
+        If `bounds` is given, then it must contain a known solution for
+        each line (or None), as a 2-tuple of output string and its total
+        cost. Prune all hypotheses that cannot become cheaper than that.
+        
+        Stop searching a line when it has expanded `beam_max_expansions`
+        hypotheses (if non-zero), and stop searching all lines at time
+        `deadline` (if given, as in `time.time()`). Such lines only get
+        the solutions found so far (which may be none).
+        
+        Return a 2-tuple: a list (for each line) of lists of solutions
+        (best first), each a 4-tuple of output string, output probabilities,
+        entropy, and soft alignment (as `BandedAlignment`);
+        and a boolean array marking the lines whose search budget was exhausted.
         '''
-        from bisect import insort_left
+        from heapq import heappush, heappop
         
         # Encode the source as state vectors.
         if encoder_outputs is None:
-            encoder_outputs = self.encoder_model.predict_on_batch(np.expand_dims(source_seq, axis=0))
-        attended_seq = encoder_outputs[0] # constant
-        attended_len = attended_seq.shape[1]
-        states_values = encoder_outputs[1:]
+            encoder_outputs = self.encoder_model.predict_on_batch(source_data)
+        attended_data = encoder_outputs[0] # constant
+        attended_len = attended_data.shape[1]
+        batch_size = source_data.shape[0]
+        # the input characters and their confidence:
+        source_idx, source_top = self._input_top(source_data)
+        # length of each line without padding (true zero):
+        source_lens = np.count_nonzero(source_top, axis=1)
+        positions = np.arange(self.alignment_width)
+        # how many candidates to consider at most per hypothesis (besides rejection)?
+        beam_width = min(self.beam_width_in, self.voc_size)
+        # which output indexes do not decode into any character?
+        underspecified = np.array([not self.mapping[1].get(idx, '')
+                                   for idx in range(self.voc_size)])
         
+        # states and outputs of all hypotheses
+        # (up to beam_width_in normal candidates plus 1 rejection candidate):
+        pool = StatePool(encoder_outputs[1:], self.voc_size, self.beam_width_in + 1,
+                         batch_size * self.batch_size,
+                         sparse_topk=self.sparse_topk if self.sparse_input else 0)
+        # how many best predictions to sort (for the beam, and with
+        # sparse_input also for feedback from the pool)?
+        top_width = max(beam_width, pool.scores.shape[1]) if self.sparse_input else beam_width
         # Start with an empty beam (no input, only state):
-        next_beam = [Node(state=states_values,
-                          value='', scores=np.zeros(self.voc_size),
-                          prob=[], cost=0.0,
-                          alignment=[],
-                          length0=attended_len,
-                          cost0=3.0)] # quite pessimistic
-        final_beam = []
+        roots = pool.add(encoder_outputs[1:],
+                         np.zeros((batch_size,) + pool.scores.shape[1:]),
+                         np.zeros((batch_size, self.beam_width_in + 1)),
+                         np.ones(batch_size))
+        # priority queues (heaps) of hypotheses for each line:
+        next_beams = [[] for _ in range(batch_size)]
+        final_beams = [[] for _ in range(batch_size)]
+        # best hypothesis for each output suffix and source position of each line:
+        recombinations = [dict() for _ in range(batch_size)]
+        cost0 = 3.0 # quite pessimistic
+        for j in range(batch_size):
+            if not source_lens[j]:
+                continue # empty line (e.g. from partially filled batch)
+            next_beams[j].append(Node(row=roots[j],
+                                      value='', prob=[], cost=0.0,
+                                      alignment=[],
+                                      length0=source_lens[j],
+                                      cost0=cost0))
+        # upper bound for the prospective cost of the solution of each line:
+        max_cost = np.full(batch_size, np.inf)
+        if bounds:
+            for j, bound in enumerate(bounds):
+                if bound:
+                    line, cost = bound
+                    # (with the empty root node, the solution is 1 longer)
+                    max_cost[j] = cost + cost0 * abs(len(line) + 1 - source_lens[j])
+        pruned = 0
+        # how many solutions have been pruned per line so far?
+        pruned_final = np.zeros(batch_size, dtype=np.int32)
         # how many batches (i.e. char hypotheses) will be processed per line at maximum?
-        max_batches = attended_len * 2 # (usually) safe limit
-        for l in range(max_batches):
-            beam = []
-            while next_beam:
-                node = next_beam.pop()
-                if node.value == '\n': # end-of-sequence symbol?
-                    insort_left(final_beam, node)
-                    # self.logger.debug('%02d found new solution %.2f/"%s"',
-                    #                   l, node.pro_cost(), str(node).strip('\n'))
-                else: # normal step
-                    beam.append(node)
-                    if node.length > 1.5 * attended_len:
-                        self.logger.warning('found overlong hypothesis "%s" in "%s"',
-                                            str(node),
-                                            ''.join(self.mapping[1][np.nanargmax(step)] for step in source_seq))
-                    # self.logger.debug('%02d new hypothesis %.2f/"%s"',
-                    #                   l, node.pro_cost(), str(node).strip('\n'))
-                if len(beam) >= self.batch_size:
-                    break # enough for one batch
+        max_batches = source_lens * 2 # (usually) safe limit
+        active = source_lens > 0
+        # how many hypotheses have been expanded per line so far?
+        expansions = np.zeros(batch_size, dtype=np.int32)
+        exhausted = np.zeros(batch_size, dtype=bool)
+        for l in range(int(np.max(max_batches))):
+            if deadline and time.time() > deadline:
+                exhausted[active] = True
+                break
+            beam = [] # fringe of all active lines
+            beam_lines = [] # line index for each hypothesis in fringe
+            for j in np.flatnonzero(active):
+                if l >= max_batches[j]:
+                    active[j] = False
+                    continue
+                if (self.beam_max_expansions and
+                    expansions[j] >= self.beam_max_expansions):
+                    active[j] = False
+                    exhausted[j] = True
+                    continue
+                max_beam = self.batch_size
+                if self.beam_max_expansions:
+                    max_beam = min(max_beam, self.beam_max_expansions - expansions[j])
+                next_beam = next_beams[j]
+                final_beam = final_beams[j]
+                line_beam = []
+                while next_beam:
+                    node = heappop(next_beam)
+                    if node.recombined: # superseded by cheaper hypothesis?
+                        pool.release([node.row]) # will not be decoded
+                        continue
+                    if node.value == '\n': # end-of-sequence symbol?
+                        heappush(final_beam, node)
+                        pool.release([node.row]) # will not be decoded
+                        # self.logger.debug('%02d found new solution %.2f/"%s"',
+                        #                   l, node.pro_cost, str(node).strip('\n'))
+                    else: # normal step
+                        line_beam.append(node)
+                        if node.length > 1.5 * source_lens[j]:
+                            self.logger.warning('found overlong hypothesis "%s" in "%s"',
+                                                str(node), self._unvectorize(source_data[j]))
+                        # self.logger.debug('%02d new hypothesis %.2f/"%s"',
+                        #                   l, node.pro_cost, str(node).strip('\n'))
+                    if len(line_beam) >= max_beam:
+                        break # enough for one batch
+                if not line_beam:
+                    active[j] = False
+                    continue # will yield no results unless we have some already
+                if (len(final_beam) + pruned_final[j] > self.beam_width_out and
+                    min(final_beam[0].pro_cost if final_beam else np.inf,
+                        max_cost[j]) < line_beam[0].pro_cost):
+                    active[j] = False
+                    continue # it is unlikely that later iterations will find better top n results
+                beam.extend(line_beam)
+                beam_lines.extend([j] * len(line_beam))
+                expansions[j] += len(line_beam)
             if not beam:
-                break # will yield StopIteration unless we have some results already
-            if (len(final_beam) > self.beam_width_out and
-                final_beam[-1].pro_cost() > beam[0].pro_cost()):
-                break # it is unlikely that later iterations will find better top n results
+                break
             
-            # use fringe leaves as minibatch, but with only 1 timestep
-            target_seq = np.expand_dims(
-                np.vstack([node.scores for node in beam]),
-                axis=1) # add time dimension
-            states_val = [np.vstack([node.state[layer] for node in beam])
-                          for layer in range(len(beam[0].state))] # stack layers across batch
-            output = self.decoder_model.predict_on_batch(
-                [target_seq, attended_seq] + states_val)
-            scores_output = output[0][:, -1] # only last timestep
-            if self.lm_predict:
-                lmscores_output = output[1][:, -1]
-                states_output = list(output[2:])
-            else:
-                states_output = list(output[1:]) # from (layers) tuple
-            for i, node in enumerate(beam): # iterate over batch (1st dim)
-                # unstack layers for current sample:
-                states = [layer[i:i+1] for layer in states_output]
-                scores = scores_output[i]
+            # use fringe leaves of all lines as minibatch, but with only 1 timestep
+            for k in range(0, len(beam), self.beam_batch_size):
+                batch = beam[k:k + self.beam_batch_size]
+                lines = beam_lines[k:k + self.beam_batch_size]
+                rows = np.array([node.row for node in batch])
+                target_seq, states_val = pool.get(rows, [node.rank for node in batch])
+                pool.release(rows) # decoded now
+                output = self.decoder_model.predict_on_batch(
+                    [np.expand_dims(target_seq, axis=1), # add time dimension
+                     attended_data[lines]] + states_val)
+                scores_output = output[0][:, -1] # only last timestep
+                if self.lm_predict:
+                    lmscores_output = output[1][:, -1]
+                    states_output = list(output[2:])
+                else:
+                    states_output = list(output[1:]) # from (layers) tuple
+                #
+                # expand all hypotheses of this batch at once:
+                scores_output = np.array(scores_output) # copy (rejection will modify)
+                # keep only the band of the alignment around the attention focus
+                # (shared by all candidates):
+                offsets, bands = _band(states_output[-1], self.alignment_width)
+                n = len(batch)
+                lines = np.array(lines)
                 #
                 # estimate current alignment target:
-                alignment = states[-1][-1]
-                misalignment = 0.0
-                if node.length > 1:
-                    prev_alignment = node.alignment
-                    prev_source_pos = np.matmul(prev_alignment, np.arange(attended_len))
-                    source_pos = np.matmul(alignment, np.arange(attended_len))
-                    misalignment = np.abs(source_pos - prev_source_pos - 1)
-                    if np.max(prev_alignment) == 1.0:
-                        # previous choice was rejection
-                        source_pos = int(prev_source_pos) + 1
-                    else:
-                        source_pos = int(source_pos.round())
-                else:
-                    source_pos = 0
+                source_pos = offsets + np.matmul(bands, positions)
+                misalignment = np.zeros(n)
+                rejected = np.zeros(n, dtype=bool) # previous choice was rejection
+                started = np.array([node.length > 1 for node in batch])
+                if np.any(started):
+                    prev_offsets, prev_bands = zip(*[node.alignment for node in batch if node.length > 1])
+                    prev_bands = np.array(prev_bands)
+                    prev_source_pos = np.array(prev_offsets) + np.matmul(prev_bands, positions)
+                    misalignment[started] = np.abs(source_pos[started] - prev_source_pos - 1)
+                    rejected[started] = np.max(prev_bands, axis=1) == 1.0
+                    source_pos[started] = np.where(rejected[started],
+                                                   prev_source_pos.astype(int) + 1,
+                                                   source_pos[started].round())
+                source_pos[~started] = 0
+                source_pos = source_pos.astype(int)
+                if self.beam_adaptive:
+                    # how uncertain is each hypothesis at this step (between 0 and 1),
+                    # judging by the OCR confidence of the input character at its
+                    # estimated source position and by the entropy of its output?
+                    source_conf = source_top[lines, np.minimum(source_pos, attended_len - 1)]
+                    source_conf[source_pos >= source_lens[lines]] = 0
+                    with np.errstate(divide='ignore', invalid='ignore'):
+                        entropy = -np.nansum(scores_output * np.log(scores_output), axis=1)
+                    entropy /= np.log(max(2, self.voc_size))
+                    uncertainty = np.clip(np.maximum(1 - source_conf, entropy), 0, 1)
+                    adaptive_width = 1 + np.ceil(uncertainty * (self.beam_width_in - 1)).astype(int)
                 #
                 # add fallback/rejection candidates regardless of beam threshold:
-                source_scores = source_seq[source_pos]
-                if (self.rejection_threshold
-                    and (misalignment < 0.1 or np.max(node.alignment) == 1.0)
-                    and np.any(source_scores)):
-                    rej_idx = np.nanargmax(source_scores)
-                    # use a fixed minimum probability
-                    if scores[rej_idx] < self.rejection_threshold:
-                        #scores *= self.rejection_threshold - scores[rej_idx] # renormalize
-                        scores[rej_idx] = self.rejection_threshold # overwrite
-                    # self.logger.debug('%s: rej=%s (%.2f)', str(node),
-                    #                   self.mapping[1][rej_idx], scores[rej_idx])
-                else:
-                    rej_idx = None
-                # 
+                rej_idx = np.full(n, -1)
+                if self.rejection_threshold:
+                    source_pos1 = np.minimum(source_pos, attended_len - 1)
+                    rejecting = np.flatnonzero((source_pos < attended_len) &
+                                               ((misalignment < 0.1) | rejected) &
+                                               (source_top[lines, source_pos1] > 0))
+                    rej_idx[rejecting] = source_idx[lines[rejecting], source_pos1[rejecting]]
+                    # use a fixed minimum probability (overwrite)
+                    scores_output[rejecting, rej_idx[rejecting]] = np.maximum(
+                        scores_output[rejecting, rej_idx[rejecting]], self.rejection_threshold)
+                #
                 # determine beam width from beam threshold to add normal candidates:
-                scores_order = np.argsort(scores) # still in reverse order (worst first)
-                highest = scores[scores_order[-1]]
-                beampos = self.voc_size - np.searchsorted(
-                    scores[scores_order],
-                    #highest - self.beam_threshold_in) # variable beam width (absolute)
-                    highest * self.beam_threshold_in) # variable beam width (relative)
+                highest = np.max(scores_output, axis=1)
+                beampos = np.count_nonzero(
+                    #scores_output >= highest[:, np.newaxis] - self.beam_threshold_in, # variable beam width (absolute)
+                    scores_output >= highest[:, np.newaxis] * self.beam_threshold_in, # variable beam width (relative)
+                    axis=1)
                 #beampos = self.beam_width_in # fixed beam width
-                beampos = min(beampos, self.beam_width_in) # mixed beam width
-                pos = 0
+                beampos = np.minimum(beampos, self.beam_width_in) # mixed beam width
+                if self.beam_adaptive:
+                    beampos = np.minimum(beampos, adaptive_width) # adaptive beam width
+                # best predictions, in true order (best first)
+                # (partial sort only, as the vocabulary can be large):
+                top = np.argpartition(-scores_output, top_width - 1, axis=1)[:, :top_width]
+                top = np.take_along_axis(top, np.argsort(-np.take_along_axis(
+                    scores_output, top, axis=1), axis=1), axis=1)
+                if self.sparse_input:
+                    # keep only the best predictions for feedback (as index/probability pairs):
+                    top_pairs = top[:, :pool.scores.shape[1]]
+                    top_pairs = np.stack([top_pairs, np.take_along_axis(scores_output, top_pairs, axis=1)],
+                                         axis=-1)
+                top = top[:, :beam_width]
+                if self.lm_predict:
+                    # use probability from LM instead of decoder for beam ratings
+                    costs_output = lmscores_output
+                else:
+                    costs_output = scores_output
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    costs = -np.log(np.take_along_axis(costs_output, top, axis=1))
+                    rej_costs = -np.log(costs_output[np.arange(n), rej_idx])
+                # (rejection can only fall off the beam if worse than all normal candidates)
+                appended = (rej_idx >= 0) & ~np.any((top == rej_idx[:, np.newaxis]) &
+                                                    (np.arange(beam_width) < beampos[:, np.newaxis]),
+                                                    axis=1)
+                candidates = []
+                for i in range(n):
+                    idxs = top[i, :beampos[i]]
+                    logscores = costs[i, :beampos[i]]
+                    if appended[i]:
+                        idxs = np.append(idxs, rej_idx[i])
+                        logscores = np.append(logscores, rej_costs[i])
+                    valid = ~(np.isnan(logscores) | underspecified[idxs])
+                    candidates.append((idxs[valid], logscores[valid]))
+                expanded = np.flatnonzero([len(idxs) for idxs, _ in candidates])
+                if not len(expanded):
+                    continue
                 #
-                # follow up on best predictions, in true order (best first):
-                for idx in reversed(scores_order):
-                    pos += 1
-                    score = scores[idx]
-                    logscore = -np.log(score)
-                    if self.lm_predict:
-                        # use probability from LM instead of decoder for beam ratings
-                        logscore = -np.log(lmscores_output[i][idx])
-                    alignment1 = alignment
-                    if idx == rej_idx:
-                        # self.logger.debug('adding rejection candidate "%s" [%.2f]',
-                        #                   self.mapping[1][rej_idx], logscore)
-                        alignment1 = np.eye(attended_len)[source_pos]
-                        rej_idx = None
-                    elif pos > beampos:
-                        if rej_idx: # not yet in beam
-                            continue # search for rejection candidate
+                # add new hypotheses to the beam:
+                # for decoder feedback, use a compromise between
+                #  - raw predictions (used in greedy decoder,
+                #    still informative of ambiguity), and
+                #  - argmax unit vectors (allowing alternatives,
+                #    but introducing label bias)
+                # already slightly better than unit vectors:
+                # scores1 *= scores[idx] / highest
+                # scores1[idx] = scores[idx] # keep
+                # only disable maxima iteratively:
+                # (i.e. each candidate's input will be the scores with
+                #  all previous candidates reset, see StatePool.get)
+                cands = np.zeros((len(expanded), self.beam_width_in + 1))
+                refs = np.zeros(len(expanded))
+                for k, i in enumerate(expanded):
+                    idxs, _ = candidates[i]
+                    cands[k, :len(idxs)] = idxs
+                    refs[k] = len(idxs)
+                new_rows = pool.add([layer[expanded] for layer in states_output],
+                                    (top_pairs if self.sparse_input else scores_output)[expanded],
+                                    cands, refs)
+                for i, row in zip(expanded, new_rows):
+                    node = batch[i]
+                    j = lines[i]
+                    for rank, (idx, logscore) in enumerate(zip(*candidates[i])):
+                        if idx == rej_idx[i]:
+                            alignment1 = _one_hot_band(source_pos[i], self.alignment_width, attended_len)
                         else:
-                            break # ignore further alternatives
-                    #
-                    # decode into string:
-                    value = self.mapping[1][idx]
-                    if (np.isnan(logscore) or
-                        value == ''): # underspecification
-                        continue # ignore this alternative
-                    #
-                    # add new hypothesis to the beam:
-                    # for decoder feedback, use a compromise between
-                    #  - raw predictions (used in greedy decoder,
-                    #    still informative of ambiguity), and
-                    #  - argmax unit vectors (allowing alternatives,
-                    #    but introducing label bias)
-                    scores1 = np.copy(scores)
-                    # already slightly better than unit vectors:
-                    # scores1 *= scores[idx] / highest
-                    # scores1[idx] = scores[idx] # keep
-                    # only disable maxima iteratively:
-                    scores[idx] = 0
-                    new_node = Node(parent=node, state=states,
-                                    value=value, scores=scores1,
-                                    prob=score, cost=logscore,
-                                    alignment=alignment1)
-                    # self.logger.debug('pro_cost: %3.3f, cum_cost: %3.1f, "%s"',
-                    #                   new_node.pro_cost(),
-                    #                   new_node.cum_cost,
-                    #                   str(new_node).strip('\n'))
-                    insort_left(next_beam, new_node)
+                            alignment1 = (offsets[i], bands[i])
+                        value = self.mapping[1][idx]
+                        new_node = Node(parent=node, row=row, rank=rank,
+                                        value=value, prob=scores_output[i, idx], cost=logscore,
+                                        alignment=alignment1)
+                        # self.logger.debug('pro_cost: %3.3f, cum_cost: %3.1f, "%s"',
+                        #                   new_node.pro_cost,
+                        #                   new_node.cum_cost,
+                        #                   str(new_node).strip('\n'))
+                        if max_cost[j] < np.inf:
+                            # least prospective cost of any solution from here
+                            # (costs only accumulate, and at least the end-of-sequence
+                            #  symbol is still missing unless already there):
+                            min_length = new_node.length + (value != '\n')
+                            if (new_node.cum_cost + cost0 * max(0, min_length - new_node.length0)
+                                > max_cost[j]):
+                                pruned += 1
+                                pruned_final[j] += value == '\n'
+                                pool.release([row]) # will not be decoded
+                                continue # cannot beat the known solution
+                        if self.beam_recombination and value != '\n':
+                            key = (new_node.suffix(self.beam_recombination), source_pos[i])
+                            old_node = recombinations[j].get(key)
+                            if old_node is not None:
+                                if old_node.pro_cost <= new_node.pro_cost:
+                                    pool.release([row]) # will not be decoded
+                                    continue # keep cheaper path
+                                # remove from beam lazily (when popped):
+                                old_node.recombined = True
+                            recombinations[j][key] = new_node
+                        heappush(next_beams[j], new_node)
             # sanitize overall beam size:
-            if len(next_beam) > max_batches * self.batch_size: # more than can ever be processed within limits?
-                next_beam = next_beam[-max_batches*self.batch_size:] # to save memory, keep only best
-        # after max_batches, we still have active hypotheses but to few inactive?
-        if next_beam and len(final_beam) < self.beam_width_out:
-            self.logger.warning('max_batches %d is not enough for beam_width_out %d: got only %d, still %d left for: "%s"',
-                                max_batches, self.beam_width_out, len(final_beam), len(next_beam),
-                                ''.join(self.mapping[1][np.nanargmax(step)] for step in source_seq))
-        while final_beam:
-            node = final_beam.pop()
-            nodes = node.to_sequence()[1:]
-            yield (''.join(n.value for n in nodes),
-                   [n.prob for n in nodes],
-                   node.cum_cost / (node.length - 1),
-                   [n.alignment for n in nodes])
+            for j in np.flatnonzero(active):
+                next_beam = next_beams[j]
+                max_beam = max_batches[j] * self.batch_size
+                if len(next_beam) > max_beam: # more than can ever be processed within limits?
+                    # to save memory, keep only best
+                    # (in-place, and a sorted list is still a heap):
+                    next_beam.sort()
+                    pool.release([node.row for node in next_beam[max_beam:]])
+                    del next_beam[max_beam:]
+        if pruned:
+            self.logger.debug('pruned %d hypotheses above known solution costs', pruned)
+        results = []
+        for j in range(batch_size):
+            next_beam = next_beams[j]
+            final_beam = final_beams[j]
+            if exhausted[j]:
+                # some solutions may still be waiting in the queue:
+                for node in next_beam:
+                    if node.value == '\n' and not node.recombined:
+                        heappush(final_beam, node)
+                self.logger.warning('beam search budget exhausted after %d hypotheses with %d solutions for: "%s"',
+                                    expansions[j], len(final_beam), self._unvectorize(source_data[j]))
+            # after max_batches, we still have active hypotheses but to few inactive?
+            elif next_beam and len(final_beam) < self.beam_width_out:
+                self.logger.warning('max_batches %d is not enough for beam_width_out %d: got only %d, still %d left for: "%s"',
+                                    max_batches[j], self.beam_width_out, len(final_beam), len(next_beam),
+                                    self._unvectorize(source_data[j]))
+            solutions = []
+            while final_beam:
+                node = heappop(final_beam)
+                nodes = node.to_sequence()[1:]
+                solutions.append((''.join(n.value for n in nodes),
+                                  [n.prob for n in nodes],
+                                  node.cum_cost / (node.length - 1),
+                                  BandedAlignment.from_steps([n.alignment for n in nodes],
+                                                             self.alignment_width, attended_len)))
+            results.append(solutions)
+        return results, exhausted
+    
+    def _unvectorize(self, source_seq):
+        '''Map encoder input line vector `source_seq` back to a string (for logging).'''
+        idxs, values = self._input_top(source_seq)
+        return ''.join(self.mapping[1][idx] for idx, value in zip(idxs, values) if value)
+
+def _join_pieces(length, pieces):
+    '''Concatenate the results for consecutive parts of a line.
+    
+    Each of `pieces` is a 5-tuple of start and end position in the
+    input line (of `length` characters), output string, output
+    probabilities and alignment (relative to the part). Drop the
+    end-of-sequence symbol from outputs of parts which did not reach
+    the end of the input line.
+    
+    Return a 4-tuple of output string, output probabilities, entropy,
+    and soft alignment (as `BandedAlignment`).
+    '''
+    line, probs, alignments = '', [], []
+    for start, end, piece_line, piece_probs, piece_alignment in pieces:
+        if end < length and piece_line.endswith('\n'):
+            piece_line = piece_line[:-1]
+            piece_probs = piece_probs[:-1]
+            piece_alignment = piece_alignment[:-1]
+        line += piece_line
+        probs.extend(piece_probs)
+        alignments.append(piece_alignment.crop(end - start).shift(start, length))
+    alignment = BandedAlignment.concatenate(alignments, length)
+    score = float(np.mean(-np.log(probs))) if probs else 0
+    return line, probs, score, alignment
+
+def _band(vectors, width):
+    '''Find the band of `width` positions with most mass in each of `vectors`.
+
+    Return a 2-tuple of start positions (one per vector), and the scores
+    within the band (one row per vector, zero-padded beyond the end).
+    '''
+    vectors = np.asarray(vectors, dtype=np.float32).reshape(len(vectors), -1)
+    if vectors.shape[1] < width:
+        vectors = np.pad(vectors, ((0, 0), (0, width - vectors.shape[1])))
+    # sum over each possible band via cumulative sums:
+    cumsum = np.cumsum(np.pad(vectors, ((0, 0), (1, 0))), axis=1)
+    offsets = np.argmax(cumsum[:, width:] - cumsum[:, :-width], axis=1)
+    scores = np.take_along_axis(vectors, offsets[:, np.newaxis] + np.arange(width), axis=1)
+    return offsets.astype(np.int32), scores
+
+def _one_hot_band(position, width, length):
+    '''Get a band of `width` positions (in `length`) with all mass at `position`.
+
+    Return a 2-tuple of start position and scores within the band.
+    '''
+    offset = min(position, max(0, length - width))
+    scores = np.zeros(width, dtype=np.float32)
+    scores[position - offset] = 1.0
+    return offset, scores
+
+class BandedAlignment(object):
+    """Soft alignment of output positions to input positions (compact)
+
+    Instead of a dense vector of scores over all `length` input positions
+    for each output position, keep only a short window of `scores` (of
+    the same width for all output positions), starting at `offsets`.
+    All scores outside the band count as zero. Since local attention only
+    ever attends to a few consecutive input positions, this is lossless
+    for bands at least as wide as the attention window.
+
+    Behaves like a list of dense vectors, though (for each output position).
+    """
+    __slots__ = ('offsets', 'scores', 'length')
+    def __init__(self, offsets, scores, length):
+        self.offsets = np.asarray(offsets, dtype=np.int32) # start of band for each output position
+        self.scores = np.asarray(scores, dtype=np.float32) # scores within band for each output position
+        self.length = length # number of input positions
+
+    @classmethod
+    def from_dense(cls, vectors, width, length=None):
+        # Compress list of dense vectors `vectors` into bands of `width`.
+        if length is None:
+            length = len(vectors[0]) if len(vectors) else 0
+        if not len(vectors):
+            return cls(np.zeros(0), np.zeros((0, width)), length)
+        return cls(*_band(vectors, width), length)
+
+    @classmethod
+    def from_steps(cls, steps, width, length):
+        # Combine list of (offset, scores) pairs `steps` for each output position.
+        if not steps:
+            return cls(np.zeros(0), np.zeros((0, width)), length)
+        offsets, scores = zip(*steps)
+        return cls(offsets, np.stack(scores), length)
+
+    @classmethod
+    def identity(cls, length, width):
+        # Align each of `length` output positions to the same input position.
+        offsets = np.minimum(np.arange(length), max(0, length - width))
+        scores = np.zeros((length, width))
+        scores[np.arange(length), np.arange(length) - offsets] = 1.0
+        return cls(offsets, scores, length)
+
+    @classmethod
+    def concatenate(cls, alignments, length):
+        # Join `alignments` (already relative to the same input) along the output.
+        return cls(np.concatenate([alignment.offsets for alignment in alignments]),
+                   np.concatenate([alignment.scores for alignment in alignments]),
+                   length)
+
+    def crop(self, length):
+        # Drop all input positions from `length` on.
+        scores = np.where(self.offsets[:, np.newaxis] + np.arange(self.scores.shape[1]) < length,
+                          self.scores, 0)
+        return BandedAlignment(self.offsets, scores, min(length, self.length))
+
+    def shift(self, start, length):
+        # Move all input positions by `start` (into an input of `length`).
+        return BandedAlignment(self.offsets + start, self.scores, length)
+
+    def positions(self):
+        # Return the input position with the highest score for each output position
+        # (or `length` where all scores are zero, i.e. beyond the end of the input).
+        return np.where(np.any(self.scores > 0, axis=1),
+                        self.offsets + np.argmax(self.scores, axis=1),
+                        self.length)
+
+    def to_dense(self):
+        # Return the full input-output matrix.
+        width = self.scores.shape[1]
+        matrix = np.zeros((len(self), max(self.length, np.max(self.offsets, initial=0) + width)),
+                          dtype=np.float32)
+        np.put_along_axis(matrix, self.offsets[:, np.newaxis] + np.arange(width), self.scores, axis=1)
+        return matrix[:, :self.length]
+
+    def __array__(self, dtype=None, copy=None):
+        matrix = self.to_dense()
+        return matrix if dtype is None else matrix.astype(dtype)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return BandedAlignment(self.offsets[index], self.scores[index], self.length)
+        vector = np.zeros(self.length, dtype=np.float32)
+        start = self.offsets[index]
+        scores = self.scores[index, :max(0, self.length - start)]
+        vector[start:start + len(scores)] = scores
+        return vector
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
 
 class Node(object):
     """One hypothesis in the character beam (trie)"""
-    def __init__(self, state, value, scores, cost, parent=None, prob=1.0, alignment=None, length0=None, cost0=None):
+    __slots__ = ('_sequence', 'value', 'parent', 'row', 'rank', 'cum_cost',
+                 'length', 'length0', 'cost0', 'prob', 'alignment',
+                 'pro_cost', 'recombined')
+    def __init__(self, row, value, cost, parent=None, rank=0, prob=1.0, alignment=None, length0=None, cost0=None):
         super(Node, self).__init__()
         self._sequence = None
         self.value = value # character
         self.parent = parent # parent Node, None for root
-        self.state = state # recurrent layer hidden state
+        self.row = row # index of recurrent layer hidden state and decoder output in StatePool
+        self.rank = rank # position among candidates of same row in StatePool
         self.cum_cost = parent.cum_cost + cost if parent else cost # e.g. -log(p) of sequence up to current node (including)
         # length of 
         self.length = 1 if parent is None else parent.length + 1
@@ -1500,11 +2774,25 @@ class Node(object):
         # urgency? (l/max_batches)...
         # probability
         self.prob = prob
-        self.scores = scores
         if alignment is None:
             self.alignment = parent.alignment if parent else []
         else:
             self.alignment = alignment
+        # for sort order, use cumulative costs plus prospective costs
+        # relative to the source length (in order to get a fair comparison
+        # across different lengths, and hence, breadth-first search),
+        # calculated only once (since it is needed for every comparison
+        # in the beam's priority queue)
+        # [must be pessimistic estimation of final cum_cost]
+        # v0.1.0:
+        #self.pro_cost = (self.cum_cost + 0.5 * math.fabs(self.length - self.length0)) / self.length
+        # v0.1.1:
+        #self.pro_cost = (self.cum_cost + self.cum_cost/self.length * max(0, self.length0 - self.length)) / self.length
+        # v0.1.2:
+        #self.pro_cost = self.cum_cost + (28 + self.cost0) * self.length0 * np.abs(1 - np.sqrt(self.length / self.length0))
+        self.pro_cost = float(self.cum_cost + self.cost0 * abs(self.length - self.length0))
+        # superseded by a cheaper hypothesis with the same suffix and source position?
+        self.recombined = False
     
     def to_sequence(self):
         # Return sequence of nodes from root to current node.
@@ -1519,29 +2807,93 @@ class Node(object):
     def __str__(self):
         return ''.join(n.value for n in self.to_sequence()[1:])
     
-    # for sort order, use cumulative costs relative to length
-    # (in order to get a fair comparison across different lengths,
-    #  and hence, breadth-first search), and use inverse order
-    # (so the faster bisect() and pop() can be used)
-    # [must be pessimistic estimation of final cum_cost]
-    def pro_cost(self):
-        # v0.1.0:
-        #return - (self.cum_cost + 0.5 * math.fabs(self.length - self.length0)) / self.length
-        # v0.1.1:
-        #return - (self.cum_cost + self.cum_cost/self.length * max(0, self.length0 - self.length)) / self.length
-        # v0.1.2:
-        #return - (self.cum_cost + (28 + self.cost0) * self.length0 * np.abs(1 - np.sqrt(self.length / self.length0)))
-        return - (self.cum_cost + self.cost0 * np.abs(self.length - self.length0))
+    def suffix(self, length):
+        # Return string of the last `length` nodes up to current node.
+        values = []
+        current_node = self
+        while current_node and len(values) < length:
+            values.insert(0, current_node.value)
+            current_node = current_node.parent
+        return ''.join(values)
     
+    # for heapq (best first)
     def __lt__(self, other):
-        return self.pro_cost() < other.pro_cost()
-    def __le__(self, other):
-        return self.pro_cost() <= other.pro_cost()
-    def __eq__(self, other):
-        return self.pro_cost() == other.pro_cost()
-    def __ne__(self, other):
-        return self.pro_cost() != other.pro_cost()
-    def __gt__(self, other):
-        return self.pro_cost() > other.pro_cost()
-    def __ge__(self, other):
-        return self.pro_cost() >= other.pro_cost()
+        return self.pro_cost < other.pro_cost
+
+class StatePool(object):
+    """Decoder states and outputs for all hypotheses in the character beam
+
+    Keep one contiguous (preallocated, but growing) array for each layer
+    of the decoder state, one for the decoder output scores, and one for
+    the order of candidates entering the beam, so hypotheses (Node) only
+    need to hold the row index (and their rank among the candidates of
+    that row). Count references of hypotheses which have not been decoded
+    yet, so rows can be recycled.
+    """
+    def __init__(self, states, voc_size, width, capacity, sparse_topk=0):
+        super(StatePool, self).__init__()
+        self.states = [np.zeros((capacity,) + layer.shape[1:], dtype=layer.dtype)
+                       for layer in states]
+        self.sparse_topk = sparse_topk
+        if sparse_topk:
+            # only the largest scores (as index/probability pairs), enough
+            # to feed back the sparse_topk best after resetting candidates:
+            self.scores = np.zeros((capacity, min(voc_size, sparse_topk + width), 2), dtype=np.float32)
+        else:
+            self.scores = np.zeros((capacity, voc_size), dtype=np.float32)
+        self.cands = np.zeros((capacity, width), dtype=np.int32)
+        self.refs = np.zeros(capacity, dtype=np.int32)
+        self.free = list(range(capacity - 1, -1, -1))
+    
+    def _grow(self, size):
+        capacity = len(self.refs)
+        new_capacity = max(2 * capacity, capacity + size)
+        def resize(array):
+            new_array = np.zeros((new_capacity,) + array.shape[1:], dtype=array.dtype)
+            new_array[:capacity] = array
+            return new_array
+        self.states = [resize(layer) for layer in self.states]
+        self.scores = resize(self.scores)
+        self.cands = resize(self.cands)
+        self.refs = resize(self.refs)
+        self.free[0:0] = range(new_capacity - 1, capacity - 1, -1)
+    
+    def add(self, states, scores, cands, refs):
+        '''Store rows of decoder `states` (list of layers), output `scores`
+        and candidate indexes `cands`, referenced by `refs` hypotheses each.
+        Return their row indexes.'''
+        size = len(refs)
+        if len(self.free) < size:
+            self._grow(size)
+        rows = np.array(self.free[-size:][::-1], dtype=np.int64)
+        del self.free[-size:]
+        for layer, values in zip(self.states, states):
+            layer[rows] = values
+        self.scores[rows] = scores
+        self.cands[rows] = cands
+        self.refs[rows] = refs
+        return rows
+    
+    def get(self, rows, ranks):
+        '''Gather decoder input and initial states for hypotheses at `rows`
+        with candidate `ranks`. (The input is the decoder output scores,
+        but with all better candidates of the same row reset.)'''
+        inputs = self.scores[rows]
+        reset = np.arange(self.cands.shape[1]) < np.expand_dims(ranks, 1)
+        if self.sparse_topk:
+            reset = np.any((inputs[:, :, np.newaxis, 0] == self.cands[rows][:, np.newaxis]) &
+                           reset[:, np.newaxis], axis=2)
+            inputs[..., 1][reset] = 0
+            # keep the largest remaining pairs:
+            best = np.argsort(-inputs[..., 1], axis=1, kind='stable')[:, :self.sparse_topk]
+            inputs = np.take_along_axis(inputs, best[:, :, np.newaxis], axis=1)
+        else:
+            inputs[np.nonzero(reset)[0], self.cands[rows][reset]] = 0
+        return inputs, [layer[rows] for layer in self.states]
+    
+    def release(self, rows):
+        '''Decrement references on `rows`, recycling them if free.'''
+        rows = np.asarray(rows, dtype=np.int64)
+        np.subtract.at(self.refs, rows, 1)
+        rows = np.unique(rows)
+        self.free.extend(rows[self.refs[rows] <= 0].tolist())
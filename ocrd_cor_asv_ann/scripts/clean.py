@@ -0,0 +1,36 @@
+# -*- coding: utf-8
+import logging
+import click
+
+from ..lib.corpus import clean
+
+@click.command()
+@click.option('-o', '--output', default="clean", help='directory for the cleaned files, report and decisions',
+              type=click.Path(file_okay=False, writable=True))
+@click.option('-j', '--processes', default=0, help='number of processes for alignment (set 0 for all cores)',
+              type=click.IntRange(min=0))
+# click.File is impossible since we do not now a priori whether
+# we have to deal with pickle dumps (mode 'rb', includes confidence)
+# or plain text files (mode 'r')
+@click.argument('data', nargs=-1, type=click.Path(dir_okay=False, exists=True))
+def cli(output, processes, data):
+    """Filter bad lines from training files.
+    
+    Align source and target of each line in the file paths `data`
+    (using `processes` in parallel), and decide whether it is too bad
+    to train on (just like `cor-asv-ann-train` would).
+    
+    Under the directory `output`, write a copy of each file with only
+    the good lines, a report of similarity ratio, edit distance and
+    decision per line (`report.tsv`), and the bad lines of both the
+    original and the cleaned files (`decisions.json`).
+    
+    Then pass `decisions.json` to `cor-asv-ann-train` (along with either
+    the original or the cleaned files), so it can skip the bad lines
+    without aligning again.
+    """
+    logging.basicConfig(format='%(asctime)s.%(msecs)03d %(levelname)s %(name)s - %(message)s',
+                        datefmt='%H:%M:%S')
+    logging.getLogger(__name__).setLevel(logging.DEBUG)
+    
+    clean(data, output, processes=processes or None, logger=logging.getLogger(__name__))
@@ -4,6 +4,7 @@ import logging
 import click
 
 from ..lib.seq2seq import Sequence2Sequence
+from ..lib.cache import CorrectionCache
 
 @click.command()
 @click.option('-m', '--load-model', default="model.h5", help='model file to load',
@@ -12,6 +13,7 @@ from ..lib.seq2seq import Sequence2Sequence
 # we have to deal with pickle dumps (mode 'rb', includes confidence)
 # or plain text files (mode 'r')
 @click.option('-f', '--fast', is_flag=True, help='only decode greedily')
+@click.option('-s', '--speculative', is_flag=True, help='decode greedily by verifying the input as draft first (faster, but results can differ from plain greedy decoding)')
 @click.option('-r', '--rejection', default=0.5, type=click.FloatRange(0,1.0),
               help='probability of the input characters in all hypotheses (set 0 to use raw predictions)')
 @click.option('-n', '--normalization', default='historic_latin', type=click.Choice(
@@ -21,8 +23,13 @@ from ..lib.seq2seq import Sequence2Sequence
               help='GT transcription level to use for historic_latin normlization (1: strongest, 3: none)')
 @click.option('-c', '--confusion', default=10, type=click.IntRange(min=0),
               help='show this number of most frequent (non-identity) edits (set 0 for none)')
+@click.option('-C', '--cache-size', default=0, type=click.IntRange(min=0),
+              help='keep this many correction results in memory to reuse for repeated lines (set 0 to disable)')
+@click.option('--cache-file', type=click.Path(dir_okay=False),
+              help='also store correction results in this SQLite file (if cache is enabled)')
 @click.argument('data', nargs=-1, type=click.Path(dir_okay=False, exists=True))
-def cli(load_model, fast, rejection, normalization, gt_level, confusion, data):
+def cli(load_model, fast, speculative, rejection, normalization, gt_level, confusion,
+        cache_size, cache_file, data):
     """Evaluate a correction model.
     
     Load a sequence-to-sequence model from the given path.
@@ -42,5 +49,10 @@ def cli(load_model, fast, rejection, normalization, gt_level, confusion, data):
     s2s.configure()
     s2s.load_weights(load_model)
     s2s.rejection_threshold = rejection
+    s2s.speculative = speculative
+    if cache_size:
+        s2s.cache = CorrectionCache(cache_size, cache_file, logger=s2s.logger)
     
     s2s.evaluate(data, fast, normalization, gt_level, confusion)
+    if s2s.cache:
+        s2s.cache.close()
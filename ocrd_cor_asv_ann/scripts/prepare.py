@@ -0,0 +1,31 @@
+# -*- coding: utf-8
+import logging
+import click
+
+from ..lib.corpus import prepare
+
+@click.command()
+@click.option('-o', '--output', default="corpus", help='directory for the compiled corpus',
+              type=click.Path(file_okay=False, writable=True))
+@click.option('-j', '--processes', default=0, help='number of processes for alignment (set 0 for all cores)',
+              type=click.IntRange(min=0))
+# click.File is impossible since we do not now a priori whether
+# we have to deal with pickle dumps (mode 'rb', includes confidence)
+# or plain text files (mode 'r')
+@click.argument('data', nargs=-1, type=click.Path(dir_okay=False, exists=True))
+def cli(output, processes, data):
+    """Compile a training corpus.
+    
+    Read the file paths `data` (just like `cor-asv-ann-train` does),
+    map their characters, find bad lines (which training would skip,
+    aligning with `processes` in parallel), and store everything as binary arrays (with a manifest) under the
+    directory `output`.
+    
+    Then pass `output` to `cor-asv-ann-train` instead of the files,
+    so it can slice the arrays directly (memory-mapped) on every epoch.
+    """
+    logging.basicConfig(format='%(asctime)s.%(msecs)03d %(levelname)s %(name)s - %(message)s',
+                        datefmt='%H:%M:%S')
+    logging.getLogger(__name__).setLevel(logging.DEBUG)
+    
+    prepare(data, output, processes=processes or None, logger=logging.getLogger(__name__))
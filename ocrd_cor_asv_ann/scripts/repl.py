@@ -49,7 +49,7 @@ def cli():
                 except:
                     ylabel = 'unknown'
                 return '%s|%s' % (xlabel, ylabel)
-        encoder_input_data, _, _, _ = s2s.vectorize_lines([source_line + '\n'], [source_line + '\n'])
+        encoder_input_data, _, _, _ = s2s.vectorize_lines([source_line + "\n"], [source_line + "\n"], sparse=s2s.sparse_input)
         gs = gridspec.GridSpec(2, 2, width_ratios=[5, 1])
         prop = font_manager.FontProperties(family=[
             # we most likely need glyphs for historic Latin codepoints:
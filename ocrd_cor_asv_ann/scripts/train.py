@@ -4,6 +4,7 @@ import logging
 import click
 
 from ..lib.seq2seq import Sequence2Sequence
+from ..lib.corpus import load_decisions
 
 @click.command()
 @click.option('-m', '--save-model', default="model.h5", help='model file for saving',
@@ -17,13 +18,17 @@ from ..lib.seq2seq import Sequence2Sequence
               type=click.IntRange(min=1, max=9128))
 @click.option('-d', '--depth', default=2, help='number of stacked hidden layers',
               type=click.IntRange(min=1, max=10))
+@click.option('--sparse-input', is_flag=True, help='feed characters as indexes instead of unit vectors (saves memory, same weights)')
 @click.option('-v', '--valdata', multiple=True, help='file to use for validation (instead of random split)',
+              type=click.Path(exists=True))
+@click.option('--decisions', help='bad-line decisions to use for data (instead of aligning again)',
               type=click.Path(dir_okay=False, exists=True))
 # click.File is impossible since we do not now a priori whether
 # we have to deal with pickle dumps (mode 'rb', includes confidence)
 # or plain text files (mode 'r')
-@click.argument('data', nargs=-1, type=click.Path(dir_okay=False, exists=True))
-def cli(save_model, load_model, init_model, reset_encoder, width, depth, valdata, data):
+# (or a directory compiled by cor-asv-ann-prepare)
+@click.argument('data', nargs=-1, type=click.Path(exists=True))
+def cli(save_model, load_model, init_model, reset_encoder, width, depth, sparse_input, valdata, decisions, data):
     """Train a correction model.
     
     Configure a sequence-to-sequence model with the given parameters.
@@ -34,10 +39,16 @@ def cli(save_model, load_model, init_model, reset_encoder, width, depth, valdata
     (Also, if its configuration has 1 less hidden layers, then fixate the loaded
     weights afterwards.)
     If given `reset_encoder`, re-initialise the encoder weights afterwards.
+    If given `sparse_input`, feed characters to the model as indexes
+    (gathering their embeddings), and use sparse targets for the loss.
     
     Then, regardless, train on the file paths `data` using early stopping.
     If no `valdata` were given, split off a random fraction of lines for
     validation. Otherwise, use only those files for validation.
+    (Instead of files, `data` and `valdata` can also be a single directory
+    compiled by `cor-asv-ann-prepare`.)
+    If given `decisions` (as written by `cor-asv-ann-clean`), skip the lines
+    recorded as bad there instead of aligning them during training.
     
     If the training has been successful, save the model under `save_model`.
     """
@@ -50,6 +61,9 @@ def cli(save_model, load_model, init_model, reset_encoder, width, depth, valdata
     s2s = Sequence2Sequence(logger=logging.getLogger(__name__), progbars=True)
     s2s.width = width
     s2s.depth = depth
+    s2s.sparse_input = sparse_input
+    if decisions:
+        s2s.line_filter = load_decisions(decisions)
     s2s.configure()
     
     # there could be both, a full pretrained model to load,
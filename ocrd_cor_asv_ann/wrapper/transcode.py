@@ -1,6 +1,7 @@
 from __future__ import absolute_import
 
 import os
+import time
 from functools import reduce
 import numpy as np
 
@@ -21,6 +22,7 @@ from ocrd_models.ocrd_page import (
 
 from .config import OCRD_TOOL
 from ..lib.seq2seq import Sequence2Sequence, GAP
+from ..lib.cache import CorrectionCache
 
 TOOL_NAME = 'ocrd-cor-asv-ann-process'
 
@@ -65,6 +67,22 @@ class ANNCorrection(Processor):
         self.s2s.rejection_threshold = self.parameter['rejection_threshold']
         self.s2s.beam_width_in = self.parameter['fixed_beam_width']
         self.s2s.beam_threshold_in = self.parameter['relative_beam_width']
+        self.s2s.beam_recombination = self.parameter['recombination_length']
+        self.s2s.beam_adaptive = self.parameter['adaptive_beam_width']
+        self.s2s.beam_max_expansions = self.parameter['expansion_budget']
+        self.s2s.beam_greedy_bound = self.parameter['greedy_bound']
+        self.s2s.speculative = self.parameter['speculative']
+        self.s2s.bucket_size = self.parameter['bucket_size']
+        self.s2s.passthrough_threshold = self.parameter['passthrough_threshold']
+        self.s2s.passthrough_spans = self.parameter['passthrough_spans']
+        self.s2s.cascade_perplexity = self.parameter['cascade_perplexity']
+        self.s2s.cascade_distance = self.parameter['cascade_distance']
+        self.s2s.window_size = self.parameter['window_size']
+        self.s2s.window_overlap = self.parameter['window_overlap']
+        if self.parameter['cache_size']:
+            self.s2s.cache = CorrectionCache(self.parameter['cache_size'],
+                                             self.parameter['cache_file'] or None,
+                                             logger=self.s2s.logger)
         
     def process(self):
         """Perform OCR post-correction with encoder-attention-decoder ANN on the workspace.
@@ -74,7 +92,9 @@ class ANNCorrection(Processor):
         as lists of lines. Concatenate their string values, obeying rules of implicit
         whitespace, and map the string positions where the objects start.
         
-        Next, transcode the input lines into output lines in parallel, and use
+        Next, transcode the input lines into output lines in parallel (gathering
+        lines of consecutive pages up to `batch_lines`, in chunks
+        of up to `chunk_size` lines and estimated `chunk_memory` MB), and use
         the retrieved soft alignment scores to calculate hard alignment paths
         between input and output string via Viterbi decoding. Then use those
         to map back the start positions and overwrite each TextEquiv with its
@@ -102,6 +122,7 @@ class ANNCorrection(Processor):
         # its classes are not hashable.
         level = self.parameter['textequiv_level']
         LOG = getLogger('processor.ANNCorrection')
+        pages = [] # queue of pages to be corrected together
         for n, input_file in enumerate(self.input_files):
             LOG.info("INPUT FILE %i / %s", n, input_file.pageId or input_file.ID)
 
@@ -117,23 +138,62 @@ class ANNCorrection(Processor):
             line_sequences = _page_get_line_sequences_at(level, pcgts)
 
             # concatenate to strings and get dict of start positions to refs:
-            input_lines, conf, textequiv_starts, word_starts, textline_starts = (
-                _line_sequences2string_sequences(self.s2s.mapping[0], line_sequences))
+            pages.append((input_file, pcgts) +
+                         _line_sequences2string_sequences(self.s2s.mapping[0], line_sequences))
             
+            # gather lines of consecutive pages up to batch_lines:
+            if sum(len(page[2]) for page in pages) < self.parameter['batch_lines']:
+                continue
+            self._process_pages(pages)
+            pages = []
+        if pages:
+            self._process_pages(pages)
+        if not self.parameter['fast_mode'] and (self.s2s.cascade_perplexity or
+                                                self.s2s.cascade_distance):
+            LOG.info("Decoded %d lines greedily and %d lines with beam search",
+                     self.s2s.cascade_counts['greedy'], self.s2s.cascade_counts['beamed'])
+        if self.s2s.cache:
+            self.s2s.cache.close()
+    
+    def _process_pages(self, pages):
+        """Correct the lines of one or more pages together, then write each page.
+        
+        Each entry of `pages` is a tuple of input file, PAGE-XML document,
+        and the line sequences from `_line_sequences2string_sequences`.
+        """
+        level = self.parameter['textequiv_level']
+        LOG = getLogger('processor.ANNCorrection')
+        input_lines, conf, textequiv_starts, word_starts, textline_starts = [], [], [], [], []
+        for _, _, page_lines, page_conf, page_textequiv_starts, page_word_starts, page_textline_starts in pages:
+            input_lines.extend(page_lines)
+            conf.extend(page_conf)
+            textequiv_starts.extend(page_textequiv_starts)
+            word_starts.extend(page_word_starts)
+            textline_starts.extend(page_textline_starts)
+        if len(pages) > 1:
+            LOG.info("Correcting %d lines of %d pages together", len(input_lines), len(pages))
+        
+        deadline = None
+        if self.parameter['page_timeout']:
+            deadline = time.time() + self.parameter['page_timeout'] * len(pages)
+        exhausted = self.s2s.exhausted_count
+        for start, end in self._get_chunks(input_lines):
+            if start > 0 or end < len(input_lines):
+                LOG.debug("Correcting lines %d-%d of %d", start, end - 1, len(input_lines))
             # correct string and get input-output alignment:
-            # FIXME: split into self.batch_size chunks
             output_lines, output_probs, output_scores, alignments = (
-                self.s2s.correct_lines(input_lines, conf,
+                self.s2s.correct_lines(input_lines[start:end], conf[start:end],
                                        fast=self.parameter['fast_mode'],
-                                       greedy=self.parameter['fast_mode']))
+                                       greedy=self.parameter['fast_mode'],
+                                       deadline=deadline))
             
             # re-align (from alignment scores) and overwrite the textequiv references:
             for (input_line, output_line, output_prob,
                  score, alignment,
                  textequivs, words, textlines) in zip(
-                     input_lines, output_lines, output_probs,
+                     input_lines[start:end], output_lines, output_probs,
                      output_scores, alignments,
-                     textequiv_starts, word_starts, textline_starts):
+                     textequiv_starts[start:end], word_starts[start:end], textline_starts[start:end]):
                 LOG.debug('"%s" -> "%s"', input_line.rstrip('\n'), output_line.rstrip('\n'))
                 
                 # convert soft scores (seen from output) to hard path (seen from input):
@@ -151,7 +211,15 @@ class ANNCorrection(Processor):
                     _resegment_sequence(new_sequence, level)
                 
                 LOG.info('corrected line with %d elements, ppl: %.3f', len(new_sequence), np.exp(score))
-            
+            # free alignment matrices before the next chunk:
+            del output_lines, output_probs, output_scores, alignments
+        exhausted = self.s2s.exhausted_count - exhausted
+        if exhausted:
+            LOG.warning("Beam search budget exhausted for %d lines of page '%s' (keeping the best or greedy solution)",
+                        exhausted, "', '".join(input_file.pageId or input_file.ID
+                                               for input_file, _, _, _, _, _, _ in pages))
+        
+        for input_file, pcgts, _, _, _, _, _ in pages:
             # make higher levels consistent again:
             page_update_higher_textequiv_levels(level, pcgts)
             
@@ -166,7 +234,58 @@ class ANNCorrection(Processor):
                 local_filename=file_path,
                 mimetype=MIMETYPE_PAGE,
                 content=to_xml(pcgts))
-            
+    
+    def _get_chunks(self, input_lines):
+        """Split the lines of a page into consecutive chunks for correction.
+        
+        Each chunk has at most `chunk_size` lines (unless zero), and
+        its estimated memory footprint (see `_estimate_memory`) must
+        not exceed `chunk_memory` MB (unless zero), but it contains at
+        least one line.
+        
+        Yield start and end index of each chunk.
+        """
+        max_lines = self.parameter['chunk_size'] or len(input_lines)
+        max_bytes = self.parameter['chunk_memory'] * 1024 * 1024
+        start = 0
+        while start < len(input_lines):
+            end = start + 1
+            max_length = len(input_lines[start])
+            while end < len(input_lines) and end - start < max_lines:
+                length = max(max_length, len(input_lines[end]))
+                if max_bytes and _estimate_memory(end + 1 - start, length, self.s2s,
+                                                 self.parameter['fast_mode']) > max_bytes:
+                    break
+                max_length = length
+                end += 1
+            yield start, end
+            start = end
+    
+def _estimate_memory(num_lines, max_length, s2s, fast=True):
+    """Estimate the peak memory (in bytes) needed to correct a number of lines.
+    
+    Count the (float32) arrays which grow with the number of lines
+    `num_lines` and the padded length `max_length`, following the
+    tensor shapes of the model:
+    - encoder input (one vocabulary-sized vector per input character),
+    - encoder output (one `width`-sized vector per input character,
+      plus the attention state per input character),
+    - decoder states (`2 * depth` vectors of `width` per line),
+    - decoder output scores (vocabulary-sized) and (banded) alignments
+      for up to twice as many output characters as input characters,
+    - and (unless `fast`) the beam of each line, with decoder states,
+      scores and attention state for up to `batch_size` hypotheses.
+    """
+    voc_size = s2s.voc_size
+    states_size = 2 * s2s.depth * s2s.width
+    size = num_lines * max_length * voc_size
+    size += num_lines * max_length * (s2s.width + 1)
+    size += num_lines * states_size
+    size += 2 * num_lines * max_length * (voc_size + s2s.alignment_width + 1)
+    if not fast:
+        size += num_lines * s2s.batch_size * (voc_size + states_size + max_length)
+    return 4 * size
+
 def _page_get_line_sequences_at(level, pcgts):
     '''Get TextEquiv sequences for PAGE-XML hierarchy level including whitespace.
     
@@ -288,41 +407,39 @@ def _line_sequences2string_sequences(mapping, line_sequences):
 def _alignment2path(alignment, i_max, j_max, min_score):
     '''Find the best path through a soft alignment matrix via Viterbi search.
     
-    The `alignment` is a list of vectors of scores (between 0..1).
-    The list indexes are output positions (ignored above `j_max`),
-    the vector indexes are input positions (ignored above `i_max`).
-    Viterbi forward scores are only calculated where the alignment
-    scores are larger than `min_score` (to save time).
+    The `alignment` is a `BandedAlignment` of scores (between 0..1).
+    Its output positions are ignored above `j_max`, its input positions
+    are ignored above `i_max`. Viterbi forward scores are only calculated
+    within the band, and where the alignment scores are larger than
+    `min_score` (to save time).
     
     Return a dictionary mapping input positions to output positions
     (i.e. a realignment path).
     '''
     # compute Viterbi forward pass:
     viterbi_fw = np.zeros((i_max, j_max), dtype=np.float32)
-    i, j = 0, 0
-    while i < i_max and j < j_max:
-        if i > 0:
-            im1 = viterbi_fw[i - 1, j]
-        else:
-            im1 = 0
-        if j > 0:
-            jm1 = viterbi_fw[i, j - 1]
-        else:
-            jm1 = 0
-        if i > 0 and j > 0:
-            ijm1 = viterbi_fw[i - 1, j - 1]
-        else:
-            ijm1 = 0
-        viterbi_fw[i, j] = alignment[j][i] + max(im1, jm1, ijm1)
-        while True:
-            i += 1
-            if i == i_max:
-                j += 1
-                if j == j_max:
-                    break
-                i = 0
-            if alignment[j][i] > min_score:
-                break
+    for j in range(min(j_max, len(alignment))):
+        start = alignment.offsets[j]
+        scores = alignment.scores[j, :max(0, i_max - start)]
+        cells = np.flatnonzero(scores > min_score)
+        if j == 0 and i_max and not (start == 0 and len(cells) and cells[0] == 0):
+            # always start at the origin
+            cells = np.insert(cells, 0, -start)
+        for k in cells:
+            i = start + k
+            if i > 0:
+                im1 = viterbi_fw[i - 1, j]
+            else:
+                im1 = 0
+            if j > 0:
+                jm1 = viterbi_fw[i, j - 1]
+            else:
+                jm1 = 0
+            if i > 0 and j > 0:
+                ijm1 = viterbi_fw[i - 1, j - 1]
+            else:
+                ijm1 = 0
+            viterbi_fw[i, j] = (scores[k] if k >= 0 else 0) + max(im1, jm1, ijm1)
     # compute Viterbi backward pass:
     i = i_max - 1 if i_max <= j_max else j_max - 2 + int(
         np.argmax(viterbi_fw[j_max - i_max - 2:, j_max - 1]))
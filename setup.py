@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 """
 Installs:
+    - cor-asv-ann-clean
+    - cor-asv-ann-prepare
     - cor-asv-ann-train
     - cor-asv-ann-eval
     - cor-asv-ann-repl
@@ -37,6 +39,8 @@ setup(
     },
     entry_points={
         'console_scripts': [
+            'cor-asv-ann-clean=ocrd_cor_asv_ann.scripts.clean:cli',
+            'cor-asv-ann-prepare=ocrd_cor_asv_ann.scripts.prepare:cli',
             'cor-asv-ann-train=ocrd_cor_asv_ann.scripts.train:cli',
             'cor-asv-ann-eval=ocrd_cor_asv_ann.scripts.eval:cli',
             'cor-asv-ann-repl=ocrd_cor_asv_ann.scripts.repl:cli',